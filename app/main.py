@@ -1,4 +1,4 @@
 import uvicorn
 
 if __name__ == "__main__":
-    uvicorn.run("server.app:app",host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run("app.server.app:app",host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
@@ -1,21 +1,41 @@
+import asyncio
 from fastapi import FastAPI, Depends
 from dotenv import load_dotenv
 from fastapi_socketio import SocketManager
 from bson import ObjectId
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import ValidationError
 from os import getenv
 from jose import jwt, JWTError
 
 from app.server.routes.user import router as UserRouter
 from app.server.routes.chatroom import router as ChatroomRouter
 from app.server.routes.message import router as MessageRouter
+from app.server.routes.admin import router as AdminRouter
 
-from app.server.database import get_db
+from app.server.database import get_db, init_indexes
+from app.server.middleware.durability import durable, STANDARD
 
 from app.server.models.chatroom import Chatroom
-from app.server.models.message import Message, MessageDetails
-from app.server.middleware.socket import app,socket_manager
-from app.server.middleware.utils import generate_chatroom_name
+from app.server.models.events import RoomEvent, ChatroomMessageEvent, ChatroomMessageBatchEvent, ReauthenticateEvent
+from app.server.middleware.auth import require_fresh_session
+from app.server.middleware.socket import app,socket_manager, negotiate_codec, enter_codec_room, leave_codec_rooms, emit_event
+from app.server.middleware.utils import backfill_chatroom_member_keys
+from app.server.middleware.inbox import sync_inbox_members, record_inbox_message, backfill_inbox
+from app.server.middleware.membership import is_large, is_member, member_ids, member_of
+from app.server.middleware.jobs import start_job_worker, stop_job_worker
+from app.server.middleware.receipts import read_receipts
+from app.server.middleware.message_store import init_message_indexes
+from app.server.middleware.spool import message_spool, store_messages
+from app.server.middleware.profiling import ProfilingMiddleware, instrument_event, loop_lag_monitor
+from app.server.middleware.validation import validate_event, event_errors, error_message
+from app.server.middleware.admission import AdmissionMiddleware
+from app.server.middleware.deadlines import DeadlineMiddleware, with_deadline
+from app.server.middleware.tasks import background_tasks
+from app.server.middleware.hash import configure_cost
+from app.server.middleware.slow_queries import slow_query_listener
+from app.server.middleware.presence import presence, JOINED, LEFT
+from app.server.middleware.memory import memory_profiler, MEMORY_TRACE_ON_START
 
 load_dotenv()
 
@@ -24,6 +44,12 @@ ALGORITHM = getenv("JWT_ALGO")
 
 db = get_db()
 
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(AdmissionMiddleware)
+
+# Added last so it is outermost: the 503s and 504s from the middleware above still
+# need CORS headers for browsers to read them (and Retry-After).
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allow all origins
@@ -35,6 +61,31 @@ app.add_middleware(
 app.include_router(UserRouter, tags=["User"],prefix="/api/user")
 app.include_router(ChatroomRouter, tags=["Chatroom"], prefix="/api/chatroom")
 app.include_router(MessageRouter,tags=["Message"], prefix="/api/message")
+app.include_router(AdminRouter, tags=["Admin"], prefix="/api/admin")
+
+@app.on_event("startup")
+async def startup():
+    await asyncio.to_thread(configure_cost)
+    await init_indexes()
+    await init_message_indexes()
+    await backfill_chatroom_member_keys()
+    await backfill_inbox()
+    await message_spool.start()
+    start_job_worker()
+    read_receipts.start()
+    loop_lag_monitor.start()
+    slow_query_listener.attach_loop(asyncio.get_running_loop())
+    if MEMORY_TRACE_ON_START:
+        await memory_profiler.set_baseline()
+
+@app.on_event("shutdown")
+async def shutdown():
+    presence.stop()
+    await background_tasks.drain()
+    await read_receipts.stop()
+    await message_spool.stop()
+    await stop_job_worker()
+    await loop_lag_monitor.stop()
 
 @app.get("/", tags=["Root"])
 async def root():
@@ -47,7 +98,8 @@ async def test_db(database=Depends(get_db)):
 
 # Socket.IO Events
 @socket_manager.on("connect")
-async def connect(sid, environ):
+@instrument_event("connect")
+async def connect(sid, environ, auth=None):
     try:
         token = environ.get("HTTP_AUTHORIZATION", None)
         if not token:
@@ -57,143 +109,200 @@ async def connect(sid, environ):
         user_id = payload.get("user_id")
         if not user_id:
             raise ConnectionRefusedError("Invalid token payload")
-        await socket_manager.save_session(sid, {"user_id": str(user_id)})
-        await socket_manager.enter_room(sid, str(user_id))
+        codec = negotiate_codec(environ, auth)
+        await socket_manager.save_session(sid, {"user_id": str(user_id), "exp": payload.get("exp", 0), "codec": codec})
+        await enter_codec_room(sid, str(user_id), codec)
 
-        await socket_manager.emit(
+        await emit_event(
             "joinedUserRoom", 
-            {"roomId": user_id}, 
-            room=str(user_id)
+            {"roomId": user_id, "codec": codec}, 
+            room=str(user_id),
+            binary=False
         )
 
-        print(f"User {user_id} connected via socket: {sid}")
+        print(f"User {user_id} connected via socket: {sid} ({codec})")
     except (JWTError, ConnectionRefusedError) as e:
         print(f"Connection refused: {e}")
         raise e
 
 @socket_manager.on("disconnect")
+@instrument_event("disconnect")
 async def disconnect(sid):
     print(f"Socket disconnected: {sid}")
 
+# Swaps the token behind a connected socket for a fresh one (from POST /api/user/refresh)
+# without reconnecting. The token must belong to the user the socket connected as.
+@socket_manager.on("reauthenticate")
+@instrument_event("reauthenticate")
+@validate_event(ReauthenticateEvent)
+async def reauthenticate(sid, event):
+    session = await socket_manager.get_session(sid)
+    try:
+        payload = jwt.decode(event.token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        await socket_manager.emit("error", {"message": "Invalid or expired token"}, room=sid)
+        return {"error": "Invalid or expired token"}
+    if str(payload.get("user_id")) != session.get("user_id"):
+        await socket_manager.emit("error", {"message": "Token belongs to a different user"}, room=sid)
+        return {"error": "Token belongs to a different user"}
+
+    session["exp"] = payload.get("exp", 0)
+    await socket_manager.save_session(sid, session)
+    return {"exp": session["exp"]}
+
 @socket_manager.on("joinRoom")
-async def join_room(sid, data):
+@with_deadline("joinRoom")
+@instrument_event("joinRoom")
+@require_fresh_session
+@validate_event(RoomEvent)
+async def join_room(sid, event):
     session = await socket_manager.get_session(sid)
     user_id = session.get("user_id")
-    chatroom_id = data.get("chatroomId")
-    if not chatroom_id:
-        return await socket_manager.emit(
-            "error", {"message": "chatroomId is required"}, room=sid
-        )
+    chatroom_id = event.chatroomId
     chatroom = await db["Chatrooms"].find_one({"_id": ObjectId(chatroom_id)})
     if not chatroom:
         return await socket_manager.emit(
             "error", {"message": "Chatroom not found"}, room=sid
         )
-    if ObjectId(user_id) not in chatroom.get("members", []):
+    if not await is_member(chatroom, user_id):
         return await socket_manager.emit(
             "error", {"message": "User not authorized to join this chatroom"}, room=sid
         )
-    await socket_manager.enter_room(sid, chatroom_id)
+    await enter_codec_room(sid, chatroom_id, session.get("codec"))
     print(f"User {user_id} joined chatroom {chatroom_id}")
-    await socket_manager.emit(
-        "notification",
-        {"message": f"User {user_id} joined the chatroom"},
-        room=str(chatroom_id),
-    )
+    await presence.notify(chatroom_id, user_id, JOINED)
 
 
 @socket_manager.on("leaveRoom")
-async def leave_room(sid, data):
-    chatroom_id = data.get("chatroomId")
-    await socket_manager.leave_room(sid, chatroom_id)
+@with_deadline("leaveRoom")
+@instrument_event("leaveRoom")
+@require_fresh_session
+@validate_event(RoomEvent)
+async def leave_room(sid, event):
+    session = await socket_manager.get_session(sid)
+    chatroom_id = event.chatroomId
+    await leave_codec_rooms(sid, chatroom_id)
     print(f"Socket {sid} left chatroom: {chatroom_id}")
-    await socket_manager.emit(
-        "notification",
-        {"message": f"User left chatroom {chatroom_id}"},
-        room=str(chatroom_id)
-    )
+    await presence.notify(chatroom_id, session.get("user_id"), LEFT)
+
+
+# Runs on background_tasks after the message has been stored and broadcast. Only the
+# sender whose update flips firstMessage announces the room, so concurrent first
+# messages don't send newChatroom twice.
+async def announce_chatroom(chatroom, user_id, last_message_id, message_count=1):
+    if not chatroom.get("firstMessage", False):
+        result = await durable("Chatrooms", STANDARD).update_one(
+            {"_id": chatroom["_id"], "firstMessage": False},
+            {"$set": {"firstMessage": True}}
+        )
+        if result.modified_count == 0:
+            return await record_inbox_message(chatroom["_id"], user_id, last_message_id, message_count)
+
+        print("Sending to users in chatroom")
+        members = await member_ids(chatroom)
+        chatroom_names = await sync_inbox_members(chatroom, members)
+        await record_inbox_message(chatroom["_id"], user_id, last_message_id, message_count)
+
+        for member in members:
+            if str(member) != str(user_id):
+                new_chatroom_data = {
+                    "_id": str(chatroom["_id"]),
+                    "name": chatroom_names[str(member)],
+                }
+                if is_large(chatroom):
+                    new_chatroom_data["memberCount"] = chatroom["memberCount"]
+                else:
+                    new_chatroom_data["members"] = [str(mem) for mem in members]
+                print(new_chatroom_data)
+                await emit_event("newChatroom", new_chatroom_data, room=str(member))
+    else:
+        await record_inbox_message(chatroom["_id"], user_id, last_message_id, message_count)
 
 
 @socket_manager.on("chatroomMessage")
-async def chatroom_message(sid, data):
+@with_deadline("chatroomMessage")
+@instrument_event("chatroomMessage")
+@require_fresh_session
+@validate_event(ChatroomMessageEvent)
+async def chatroom_message(sid, event):
     session = await socket_manager.get_session(sid)
     user_id = session.get("user_id")
-    chatroom_id = data.get("chatroomId")
-    message_details = data.get("message")
-    if not chatroom_id:
-        return await socket_manager.emit(
-            "error", {"message": "chatroomId is required"}, room=sid
-        )
-    if not message_details:
-        return await socket_manager.emit(
-            "error", {"message": "Message details are required"}, room=sid
-        )
-    if not message_details.get("content") or message_details["content"].strip() == "":
-        return await socket_manager.emit(
-            "error", {"message": "Message content cannot be empty"}, room=sid
-        )
-    if not message_details.get("DHKey") or not message_details.get("timestamp"):
-        return await socket_manager.emit(
-            "error", {"message": "DHKey and timestamp are required"}, room=sid
-        )
+    chatroom_id = event.chatroomId
     
     chatroom = await db["Chatrooms"].find_one({"_id": ObjectId(chatroom_id)})
     if not chatroom:
         return await socket_manager.emit(
             "error", {"message": "Chatroom not found"}, room=sid
         )
-    if ObjectId(user_id) not in chatroom.get("members", []):
+    if not await is_member(chatroom, user_id):
         return await socket_manager.emit(
             "error", {"message": "User is not a member of this chatroom"}, room=sid
         )
-    message = Message(
-        chatroom=chatroom_id,
-        sender=user_id,
-        message=MessageDetails(
-            content=message_details["content"],
-            DHKey=message_details["DHKey"],
-            timestamp=message_details["timestamp"],
-            ephKey=message_details.get("ephKey"),
-            otpID=message_details.get("otpID"),
-        )
-    )
-
-    result = await db["Messages"].insert_one(message.dict(by_alias=True))
-    saved_message = message.dict(by_alias=True)
-    saved_message["_id"] = str(result.inserted_id)
-
-    print(f"Message saved in chatroom {chatroom_id}: {message_details['content']}")
-    await socket_manager.emit(
-        "newMessage",
-        {
-            "_id": saved_message["_id"],
-            "chatroom": chatroom_id,
-            "sender": user_id,
-            "message": {
-                "content": message_details["content"],
-                "DHKey": message_details["DHKey"],
-                "ephKey": message_details.get("ephKey"),
-                "otpID": message_details.get("otpID"),
-                "timestamp": message_details["timestamp"]
-            }
-        },
-        room=chatroom_id,
-    )
+    document, payload = event.to_documents(user_id)
 
-    if not chatroom.get("firstMessage", False):
-        print("Sending to users in chatroom")
-        await db["Chatrooms"].update_one(
-            {"_id": chatroom["_id"]},
-            {"$set": {"firstMessage": True}}
+    await store_messages([document])
+
+    print(f"Message saved in chatroom {chatroom_id}: {event.message.content}")
+    await emit_event("newMessage", payload, room=chatroom_id)
+
+    background_tasks.submit("announceChatroom", announce_chatroom(chatroom, user_id, document["_id"]))
+
+
+@socket_manager.on("chatroomMessageBatch")
+@with_deadline("chatroomMessageBatch")
+@instrument_event("chatroomMessageBatch")
+@require_fresh_session
+@validate_event(ChatroomMessageBatchEvent)
+async def chatroom_message_batch(sid, event):
+    session = await socket_manager.get_session(sid)
+    user_id = session.get("user_id")
+
+    results = [None] * len(event.messages)
+    pending = []
+    for index, item in enumerate(event.messages):
+        try:
+            pending.append((index, ChatroomMessageEvent.model_validate(item)))
+        except ValidationError as e:
+            errors = event_errors(e)
+            results[index] = {"error": error_message(errors), "errors": errors}
+
+    chatrooms = {}
+    if pending:
+        found = await db["Chatrooms"].find(
+            {"_id": {"$in": list({ObjectId(item.chatroomId) for _, item in pending})}}
+        ).to_list(None)
+        chatrooms = {str(chatroom["_id"]): chatroom for chatroom in found}
+        joined = await member_of(found, user_id)
+
+    documents = []
+    by_room = {}
+    for index, item in pending:
+        chatroom = chatrooms.get(item.chatroomId)
+        if not chatroom:
+            results[index] = {"error": "Chatroom not found"}
+        elif chatroom["_id"] not in joined:
+            results[index] = {"error": "User is not a member of this chatroom"}
+        else:
+            document, payload = item.to_documents(user_id)
+            documents.append(document)
+            by_room.setdefault(item.chatroomId, []).append(payload)
+            results[index] = {"_id": payload["_id"]}
+
+    if not documents:
+        return {"results": results}
+
+    await store_messages(documents)
+
+    print(f"Saved {len(documents)} batched messages across {len(by_room)} chatrooms")
+    for chatroom_id, payloads in by_room.items():
+        await emit_event(
+            "newMessageBatch",
+            {"chatroom": chatroom_id, "messages": payloads},
+            room=chatroom_id,
+        )
+        background_tasks.submit(
+            "announceChatroom",
+            announce_chatroom(chatrooms[chatroom_id], user_id, payloads[-1]["_id"], len(payloads))
         )
 
-        for member in chatroom["members"]:
-            if str(member) != str(user_id):
-                member_chatroom_name = await generate_chatroom_name(chatroom["members"], member)
-                new_chatroom_data = {
-                    "_id": str(chatroom["_id"]),
-                    "name": member_chatroom_name,
-                    "members": [str(mem) for mem in chatroom["members"]]
-                }
-                print(new_chatroom_data)
-                await socket_manager.emit("newChatroom", new_chatroom_data, room=str(member))
\ No newline at end of file
+    return {"results": results}
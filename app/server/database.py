@@ -6,15 +6,46 @@ from os import getenv
 load_dotenv()
 
 URI = getenv("DB_URI")
-client = AsyncIOMotorClient(URI) if URI else None
+client = None
 
-def get_db():
+# The client is created on first use rather than at import, so the app module can be
+# imported (e.g. before forking workers) without opening connections.
+def get_client():
+    global client
     if not client:
-        raise ValueError("MongoDB client is not initialized. Check your DB_URI environment variable.")
-    return client["Anonymouse"]
+        if not URI:
+            raise ValueError("MongoDB client is not initialized. Check your DB_URI environment variable.")
+        # Imported here so it picks up settings from .env, loaded above.
+        from app.server.middleware.slow_queries import slow_query_listener
+        client = AsyncIOMotorClient(URI, event_listeners=[slow_query_listener])
+    return client
 
 
+class LazyDatabase:
+    def __getitem__(self, name):
+        return get_client()["Anonymouse"][name]
 
+    def __getattr__(self, name):
+        return getattr(get_client()["Anonymouse"], name)
 
 
+database = LazyDatabase()
 
+def get_db():
+    return database
+
+
+async def init_indexes():
+    db = get_db()
+    await db["Inbox"].create_index([("user", 1), ("chatroom", 1)], unique=True)
+    await db["Inbox"].create_index([("user", 1), ("lastMessageAt", -1)])
+    await db["Inbox"].create_index("chatroom")
+    await db["Chatrooms"].create_index(
+        "memberKey", unique=True, partialFilterExpression={"memberKey": {"$type": "string"}}
+    )
+    await db["Memberships"].create_index([("chatroom", 1), ("user", 1)], unique=True)
+    await db["Memberships"].create_index([("user", 1), ("chatroom", 1)])
+    await db["Jobs"].create_index([("status", 1), ("lockedUntil", 1), ("createdAt", 1)])
+    await db["RefreshTokens"].create_index("expiresAt", expireAfterSeconds=0)
+    await db["RefreshTokens"].create_index("user")
+    await db["RefreshTokens"].create_index("family")
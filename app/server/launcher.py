@@ -0,0 +1,128 @@
+import argparse
+import os
+import signal
+import socket
+import time
+from os import getenv
+
+import uvicorn
+
+APP = "app.server.app:app"
+
+# Production entry point: binds the listening socket once, then forks workers that
+# all accept on it. Crashed workers are replaced until the launcher is told to stop.
+#
+#   python -m app.server.launcher --workers 4 --loop uvloop --http httptools
+#
+# Each worker has its own Socket.IO server with no shared message queue, so an emit
+# only reaches sockets connected to the worker that made it, and an Engine.IO
+# long-poll landing on another worker finds no session. One worker is the default for
+# that reason; more are only safe for deployments that don't rely on Socket.IO.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the Anonymouse backend with prefork workers.")
+    parser.add_argument("--host", default=getenv("WEB_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(getenv("WEB_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(getenv("WEB_WORKERS", "1")))
+    parser.add_argument("--loop", default=getenv("WEB_LOOP", "auto"), choices=["auto", "asyncio", "uvloop"])
+    parser.add_argument("--http", default=getenv("WEB_HTTP", "auto"), choices=["auto", "h11", "httptools"])
+    parser.add_argument("--backlog", type=int, default=int(getenv("WEB_BACKLOG", "2048")))
+    parser.add_argument(
+        "--preload", action="store_true", default=getenv("WEB_PRELOAD", "") == "1",
+        help="Import the app before forking so workers share its pages. Connections are still opened per worker."
+    )
+    return parser.parse_args()
+
+
+def bind_socket(host, port, backlog):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock, args, app):
+    config = uvicorn.Config(
+        app,
+        loop=args.loop,
+        http=args.http,
+        backlog=args.backlog,
+        lifespan="on",
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def spawn_worker(sock, args, app):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        code = 0
+        try:
+            run_worker(sock, args, app)
+        except BaseException as e:
+            print(f"Worker {os.getpid()} crashed: {e}")
+            code = 1
+        finally:
+            os._exit(code)
+    print(f"Started worker {pid}")
+    return pid
+
+
+def main():
+    args = parse_args()
+    sock = bind_socket(args.host, args.port, args.backlog)
+
+    # Calibrate once so every worker hashes (and rehashes on login) with the same cost.
+    if not os.environ.get("BCRYPT_COST"):
+        from app.server.middleware.hash import calibrate_cost
+        os.environ["BCRYPT_COST"] = str(calibrate_cost()[0])
+
+    app = APP
+    if args.preload:
+        from app.server.app import app
+
+    workers = {}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print(f"Listening on {args.host}:{args.port} with {args.workers} workers (loop={args.loop}, http={args.http})")
+    if args.workers > 1:
+        print("Socket.IO events are not shared between workers: clients only receive emits made by the worker they are connected to")
+    for _ in range(args.workers):
+        workers[spawn_worker(sock, args, app)] = time.monotonic()
+
+    while workers:
+        try:
+            pid, wait_status = os.wait()
+        except ChildProcessError:
+            break
+
+        started = workers.pop(pid, None)
+        if started is None or stopping:
+            continue
+
+        print(f"Worker {pid} exited with code {os.waitstatus_to_exitcode(wait_status)}, restarting")
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        if stopping:
+            continue
+        workers[spawn_worker(sock, args, app)] = time.monotonic()
+
+    sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+from fastapi import Request, HTTPException, status
+from os import getenv
+from hmac import compare_digest
+
+ADMIN_TOKEN = getenv("ADMIN_TOKEN")
+
+def is_admin_token(token) -> bool:
+    if not ADMIN_TOKEN or not token:
+        return False
+    return compare_digest(token, ADMIN_TOKEN)
+
+async def require_admin(request: Request):
+    if not is_admin_token(request.headers.get("X-Admin-Token")):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin access required.",
+        )
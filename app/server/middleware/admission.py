@@ -0,0 +1,97 @@
+import json
+from os import getenv
+
+from app.server.middleware.metrics import increment, register_gauge
+from app.server.middleware.profiling import route_label, loop_lag_monitor
+
+
+ADMISSION_MAX_INFLIGHT = int(getenv("ADMISSION_MAX_INFLIGHT", "256"))
+ADMISSION_RETRY_AFTER = int(getenv("ADMISSION_RETRY_AFTER", "1"))
+
+CRITICAL = "critical"
+NORMAL = "normal"
+LOW = "low"
+
+# Requests are shed once in-flight requests or event-loop lag pass the limit for their
+# priority. Low-priority reads go first, critical routes keep headroom up to the hard cap.
+LIMITS = {
+    LOW: {
+        "inflight": int(ADMISSION_MAX_INFLIGHT * float(getenv("ADMISSION_LOW_INFLIGHT_RATIO", "0.5"))),
+        "lag": float(getenv("ADMISSION_LOW_LAG_MS", "100")) / 1000,
+    },
+    NORMAL: {
+        "inflight": int(ADMISSION_MAX_INFLIGHT * float(getenv("ADMISSION_NORMAL_INFLIGHT_RATIO", "0.8"))),
+        "lag": float(getenv("ADMISSION_NORMAL_LAG_MS", "250")) / 1000,
+    },
+    CRITICAL: {
+        "inflight": ADMISSION_MAX_INFLIGHT,
+        "lag": None,
+    },
+}
+
+ROUTE_PRIORITIES = {
+    "POST /api/user/login": CRITICAL,
+    "POST /api/user/refresh": CRITICAL,
+    "POST /api/message/": CRITICAL,
+    "GET /api/user/": LOW,
+    "GET /api/user/name/{userName}": LOW,
+    "GET /api/message/{chatroom_id}": LOW,
+    "GET /api/message/unread": LOW,
+}
+
+# Socket.IO traffic (connects, long-polls carrying message sends) is never shed and,
+# since long-polls stay open by design, not counted as in-flight either. Admin routes
+# (metrics, profiles, slow queries, memory) are how an operator diagnoses overload, so
+# they are never shed either.
+UNMETERED_PREFIXES = ("/socket.io", "/api/admin")
+
+_inflight = 0
+register_gauge("http_requests_inflight", lambda: _inflight)
+
+
+def route_priority(label):
+    return ROUTE_PRIORITIES.get(label, NORMAL)
+
+
+def should_shed(priority, inflight, lag):
+    limit = LIMITS[priority]
+    if inflight >= limit["inflight"]:
+        return True
+    return limit["lag"] is not None and lag >= limit["lag"]
+
+
+async def _reject(send):
+    body = json.dumps({"detail": "Server is busy, please retry shortly."}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(ADMISSION_RETRY_AFTER).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _inflight
+        if scope["type"] != "http" or scope["path"].startswith(UNMETERED_PREFIXES):
+            return await self.app(scope, receive, send)
+
+        label = route_label(scope)
+        priority = route_priority(label)
+        if should_shed(priority, _inflight, loop_lag_monitor.lag):
+            increment("admission_shed_total", {"priority": priority, "route": label})
+            return await _reject(send)
+
+        increment("admission_admitted_total", {"priority": priority})
+        _inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _inflight -= 1
@@ -1,9 +1,28 @@
 from jose import jwt, JWTError
 from fastapi import Request, HTTPException, status, Depends
+from functools import wraps
+from datetime import datetime, timedelta
+import time
 from os import getenv
 
+from app.server.middleware.socket import socket_manager
+
 SECRET_KEY = getenv("JWT_SECRET")
 ALGORITHM = getenv("JWT_ALGO") 
+ACCESS_TOKEN_MINUTES = int(getenv("ACCESS_TOKEN_MINUTES", "15"))
+# When set, socket events are refused once the token the socket connected (or last
+# reauthenticated) with has expired, so clients must send "reauthenticate" in time.
+SOCKET_REQUIRE_FRESH_TOKEN = getenv("SOCKET_REQUIRE_FRESH_TOKEN", "0") == "1"
+
+def create_access_token(user_id: str):
+    now = datetime.utcnow()
+    expiration = now + timedelta(minutes=ACCESS_TOKEN_MINUTES)
+    payload = {
+        "user_id": str(user_id),
+        "exp": expiration,
+        "iat": now,
+    }
+    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM), expiration
 
 async def authenticate_user(request: Request):
     authorization: str = request.headers.get("Authorization")
@@ -21,4 +40,17 @@ async def authenticate_user(request: Request):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or expired token.",
-        )
\ No newline at end of file
+        )
+
+def require_fresh_session(handler):
+    @wraps(handler)
+    async def wrapper(sid, *args):
+        if SOCKET_REQUIRE_FRESH_TOKEN:
+            session = await socket_manager.get_session(sid)
+            # exp is a Unix timestamp; utcnow().timestamp() would read it as local time.
+            if session.get("exp", 0) < time.time():
+                message = "Session token expired, send reauthenticate with a new token."
+                await socket_manager.emit("error", {"message": message}, room=sid)
+                return {"error": message}
+        return await handler(sid, *args)
+    return wrapper
@@ -0,0 +1,115 @@
+import asyncio
+import json
+from functools import wraps
+from os import getenv
+
+import pymongo
+from pymongo.errors import PyMongoError
+
+from app.server.middleware.metrics import increment
+from app.server.middleware.profiling import route_label
+from app.server.middleware.socket import socket_manager
+
+
+def _parse_deadlines(value):
+    deadlines = {}
+    for entry in value.split(","):
+        if "=" in entry:
+            label, ms = entry.rsplit("=", 1)
+            deadlines[label.strip()] = int(ms)
+    return deadlines
+
+
+# Every HTTP request and socket event runs under a deadline. Motor operations inside
+# it get the remaining budget as maxTimeMS (via pymongo.timeout, which Motor carries
+# into its executor threads), and the handler as a whole is cancelled when it runs out.
+# Override per route with DEADLINE_ROUTES="GET /api/user/=1500,POST /api/chatroom/=3000"
+# and per event with DEADLINE_EVENTS="chatroomMessageBatch=4000".
+DEADLINE_DEFAULT_MS = int(getenv("DEADLINE_DEFAULT_MS", "5000"))
+
+ROUTE_DEADLINES_MS = {
+    "GET /api/user/": 2000,
+    "GET /api/user/name/{userName}": 1000,
+    "GET /api/message/unread": 3000,
+    **_parse_deadlines(getenv("DEADLINE_ROUTES", "")),
+}
+EVENT_DEADLINES_MS = _parse_deadlines(getenv("DEADLINE_EVENTS", ""))
+
+# Socket.IO long-polls stay open by design; their events get deadlines individually.
+EXEMPT_PREFIXES = ("/socket.io",)
+
+TIMEOUT_MESSAGE = "Request timed out."
+
+
+def is_timeout(error):
+    return isinstance(error, asyncio.TimeoutError) or (isinstance(error, PyMongoError) and error.timeout)
+
+
+# Lifts the deadline for work that outlives the request, like background tasks spawned
+# from a handler (they inherit its context). With no timeout set pymongo stops
+# computing a remaining budget, so no maxTimeMS is sent.
+def without_deadline():
+    return pymongo.timeout(None)
+
+
+async def _timed_out(send):
+    body = json.dumps({"detail": TIMEOUT_MESSAGE}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 504,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class DeadlineMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(EXEMPT_PREFIXES):
+            return await self.app(scope, receive, send)
+
+        label = route_label(scope)
+        seconds = ROUTE_DEADLINES_MS.get(label, DEADLINE_DEFAULT_MS) / 1000
+        started = False
+
+        async def send_wrapper(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            with pymongo.timeout(seconds):
+                await asyncio.wait_for(self.app(scope, receive, send_wrapper), seconds)
+        except Exception as e:
+            if not is_timeout(e):
+                raise
+            increment("deadline_exceeded_total", {"operation": label})
+            print(f"{label} exceeded its {seconds * 1000:.0f}ms deadline: {e!r}")
+            if not started:
+                await _timed_out(send)
+
+
+def with_deadline(event):
+    seconds = EVENT_DEADLINES_MS.get(event, DEADLINE_DEFAULT_MS) / 1000
+
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(sid, *args):
+            try:
+                with pymongo.timeout(seconds):
+                    return await asyncio.wait_for(handler(sid, *args), seconds)
+            except Exception as e:
+                if not is_timeout(e):
+                    raise
+                increment("deadline_exceeded_total", {"operation": f"socket {event}"})
+                print(f"socket {event} exceeded its {seconds * 1000:.0f}ms deadline: {e!r}")
+                await socket_manager.emit("error", {"message": TIMEOUT_MESSAGE}, room=sid)
+                return {"error": TIMEOUT_MESSAGE}
+        return wrapper
+    return decorator
@@ -0,0 +1,51 @@
+from os import getenv
+
+from pymongo import WriteConcern
+
+from app.server.database import get_db
+
+
+db = get_db()
+
+# Every write names how durable it has to be instead of inheriting the client default:
+#   critical  accounts, credentials, key material and OTP claims, membership, tokens
+#   standard  messages, inbox rows, job bookkeeping, anything rebuilt from the above
+#   fast      read receipts, unread counters, job progress, last-message markers
+# Each maps to a write concern that can be overridden per deployment, e.g.
+# DURABILITY_STANDARD="w=majority,wtimeout=2000". Code at critical and standard write
+# sites may read the write result (matched counts, upserted ids), so only
+# DURABILITY_FAST can safely be set to w=0.
+CRITICAL = "critical"
+STANDARD = "standard"
+FAST = "fast"
+
+DEFAULT_PROFILES = {
+    CRITICAL: "w=majority,j=true",
+    STANDARD: "w=1,j=true",
+    FAST: "w=1,j=false",
+}
+
+
+def parse_write_concern(value):
+    options = {}
+    for entry in value.split(","):
+        if "=" not in entry:
+            continue
+        key, setting = (part.strip() for part in entry.split("=", 1))
+        if key in ("j", "fsync"):
+            options[key] = setting.lower() in ("1", "true", "yes")
+        elif key in ("w", "wtimeout"):
+            options[key] = int(setting) if setting.isdigit() else setting
+        else:
+            raise ValueError(f"Unknown write concern option {key!r} in {value!r}")
+    return WriteConcern(**options)
+
+
+WRITE_CONCERNS = {
+    profile: parse_write_concern(getenv(f"DURABILITY_{profile.upper()}", default))
+    for profile, default in DEFAULT_PROFILES.items()
+}
+
+
+def durable(collection, profile):
+    return db[collection].with_options(write_concern=WRITE_CONCERNS[profile])
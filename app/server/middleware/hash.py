@@ -1,11 +1,68 @@
 import bcrypt
+import time
 from datetime import datetime
+from os import getenv
+
+# The bcrypt work factor is picked at startup so a verify takes about BCRYPT_TARGET_MS
+# on this host, within [BCRYPT_MIN_COST, BCRYPT_MAX_COST]. BCRYPT_COST pins it instead
+# (the prefork launcher calibrates once and passes the result to every worker this way).
+BCRYPT_TARGET_MS = float(getenv("BCRYPT_TARGET_MS", "250"))
+BCRYPT_MIN_COST = int(getenv("BCRYPT_MIN_COST", "10"))
+BCRYPT_MAX_COST = int(getenv("BCRYPT_MAX_COST", "16"))
+DEFAULT_COST = 12
+
+bcrypt_cost = DEFAULT_COST
+
+
+def _time_hash(cost):
+    salt = bcrypt.gensalt(cost)
+    started = time.perf_counter()
+    bcrypt.hashpw(b"calibration-password", salt)
+    return (time.perf_counter() - started) * 1000
+
+
+# Each extra round doubles the work, so one timing at the minimum cost is enough to
+# estimate the rest. Takes the fastest of three runs to ignore scheduler noise.
+def calibrate_cost(target_ms=BCRYPT_TARGET_MS):
+    base_ms = min(_time_hash(BCRYPT_MIN_COST) for _ in range(3))
+    cost = BCRYPT_MIN_COST
+    while cost < BCRYPT_MAX_COST and base_ms * 2 ** (cost + 1 - BCRYPT_MIN_COST) <= target_ms:
+        cost += 1
+    return cost, base_ms * 2 ** (cost - BCRYPT_MIN_COST)
+
+
+def configure_cost():
+    global bcrypt_cost
+    pinned = getenv("BCRYPT_COST")
+    if pinned:
+        bcrypt_cost = int(pinned)
+        print(f"Using bcrypt cost {bcrypt_cost} from BCRYPT_COST")
+        return bcrypt_cost
+
+    bcrypt_cost, estimate_ms = calibrate_cost()
+    print(f"Calibrated bcrypt cost {bcrypt_cost} (~{estimate_ms:.0f}ms per hash, target {BCRYPT_TARGET_MS:.0f}ms)")
+    return bcrypt_cost
+
+
+# Reads the cost from the hash itself, e.g. "$2b$12$..." -> 12.
+def hash_cost(hashed_password: str) -> int:
+    try:
+        return int(hashed_password.split("$")[2])
+    except (IndexError, ValueError):
+        return 0
+
+
+# Only ever upward: workers that calibrate independently can land on different costs,
+# and rehashing both ways would flip a user's hash between them on every login.
+def needs_rehash(hashed_password: str) -> bool:
+    return hash_cost(hashed_password) < bcrypt_cost
+
 
 #combine password with timestamp and then hash it, return the hashed password and the salt together
 def hash_password(password: str) -> dict:
     timestamp = datetime.utcnow().isoformat()
     salted_password = f"{password}{timestamp}"
-    hashed_password = bcrypt.hashpw(salted_password.encode('utf-8'), bcrypt.gensalt())
+    hashed_password = bcrypt.hashpw(salted_password.encode('utf-8'), bcrypt.gensalt(bcrypt_cost))
 
     return {"hashed_password": hashed_password.decode('utf-8'), "salt": timestamp}
 
@@ -14,4 +71,4 @@ def hash_password(password: str) -> dict:
 def verify_password(password: str, salt: str, hashed_password: str) -> bool:
     salted_password = f"{password}{salt}"
 
-    return bcrypt.checkpw(salted_password.encode('utf-8'), hashed_password.encode('utf-8'))
\ No newline at end of file
+    return bcrypt.checkpw(salted_password.encode('utf-8'), hashed_password.encode('utf-8'))
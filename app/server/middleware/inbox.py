@@ -0,0 +1,114 @@
+from datetime import datetime
+from bson import ObjectId
+from pymongo import UpdateOne, UpdateMany, DESCENDING
+
+from app.server.database import get_db
+from app.server.middleware.durability import durable, STANDARD, FAST
+from app.server.middleware.membership import is_large, large_room_name, member_ids
+from app.server.middleware.message_store import latest_message_id
+from app.server.middleware.utils import generate_chatroom_names
+
+
+db = get_db()
+
+INBOX_BACKFILL = "inboxBackfill"
+
+# One Inbox row per (user, chatroom), kept up to date by the message, read and
+# membership write paths so listing a user's chatrooms is a single indexed query.
+
+# Large rooms share one name across every row and don't copy the member list, so
+# their existing rows are refreshed with one update and only the given users (e.g.
+# someone who just joined) are upserted. New rows start at last_message_id when given.
+async def sync_inbox_members(chatroom, users=None, last_message_id=None):
+    if is_large(chatroom):
+        name = await large_room_name(chatroom)
+        fields = {"name": name, "members": [], "memberCount": chatroom["memberCount"]}
+        await durable("Inbox", STANDARD).update_many({"chatroom": chatroom["_id"]}, {"$set": fields})
+        members = users or []
+        names = {str(member): name for member in members}
+    else:
+        members = chatroom["members"]
+        names = await generate_chatroom_names(members)
+        fields = {"members": [str(member) for member in members]}
+    if not members:
+        return names
+
+    await durable("Inbox", STANDARD).bulk_write([
+        UpdateOne(
+            {"user": ObjectId(member), "chatroom": chatroom["_id"]},
+            {
+                "$set": {**fields, "name": names[str(member)]},
+                "$setOnInsert": {
+                    "lastMessageId": last_message_id,
+                    "lastMessageAt": last_message_id.generation_time if last_message_id else datetime.utcnow(),
+                    "unreadCount": 0
+                }
+            },
+            upsert=True
+        )
+        for member in members
+    ], ordered=False)
+    if not is_large(chatroom):
+        await durable("Inbox", STANDARD).delete_many(
+            {"chatroom": chatroom["_id"], "user": {"$nin": [ObjectId(member) for member in members]}}
+        )
+
+    return names
+
+
+async def record_inbox_message(chatroom_id, sender_id, message_id, message_count=1):
+    last_message = {"lastMessageId": ObjectId(message_id), "lastMessageAt": datetime.utcnow()}
+
+    await durable("Inbox", FAST).bulk_write([
+        UpdateMany(
+            {"chatroom": ObjectId(chatroom_id), "user": {"$ne": ObjectId(sender_id)}},
+            {"$set": last_message, "$inc": {"unreadCount": message_count}}
+        ),
+        UpdateOne(
+            {"chatroom": ObjectId(chatroom_id), "user": ObjectId(sender_id)},
+            {"$set": last_message}
+        )
+    ], ordered=False)
+
+
+async def mark_inbox_read(read_counts):
+    if not read_counts:
+        return
+
+    await durable("Inbox", FAST).bulk_write([
+        UpdateOne(
+            {"chatroom": ObjectId(chatroom_id), "user": ObjectId(user_id)},
+            [{"$set": {"unreadCount": {"$max": [0, {"$subtract": ["$unreadCount", count]}]}}}]
+        )
+        for (user_id, chatroom_id), count in read_counts.items()
+    ], ordered=False)
+
+
+async def remove_inbox_chatroom(chatroom_id):
+    await durable("Inbox", STANDARD).delete_many({"chatroom": ObjectId(chatroom_id)})
+
+
+async def get_inbox(user_id):
+    return await db["Inbox"].find(
+        {"user": ObjectId(user_id)}
+    ).sort("lastMessageAt", DESCENDING).to_list(None)
+
+
+# One-time migration giving every member of every announced chatroom an Inbox row,
+# dated by the room's real last message. Rooms announced afterwards get their rows
+# from the write paths. Safe to run on several workers at once, the upserts only
+# fill in missing rows.
+async def backfill_inbox():
+    if await db["Migrations"].find_one({"_id": INBOX_BACKFILL}):
+        return
+
+    synced = 0
+    async for chatroom in db["Chatrooms"].find({"firstMessage": True}):
+        users = await member_ids(chatroom) if is_large(chatroom) else None
+        await sync_inbox_members(chatroom, users, await latest_message_id(chatroom["_id"]))
+        synced += 1
+
+    await durable("Migrations", STANDARD).update_one(
+        {"_id": INBOX_BACKFILL}, {"$set": {"completedAt": datetime.utcnow()}}, upsert=True
+    )
+    print(f"Backfilled inbox rows for {synced} chatrooms")
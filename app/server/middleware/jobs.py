@@ -0,0 +1,231 @@
+import asyncio
+from datetime import datetime, timedelta
+from os import getenv
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.server.database import get_db
+from app.server.middleware.durability import durable, CRITICAL, STANDARD, FAST
+from app.server.middleware.utils import chatroom_member_key
+from app.server.middleware.inbox import remove_inbox_chatroom, sync_inbox_members
+from app.server.middleware.membership import is_large, member_filter, remove_chatroom_memberships, remove_large_member
+from app.server.middleware.message_store import delete_chatroom_messages_chunk, delete_sender_messages_chunk
+
+
+db = get_db()
+
+JOB_CHUNK_SIZE = int(getenv("JOB_CHUNK_SIZE", "500"))
+JOB_THROTTLE_MS = int(getenv("JOB_THROTTLE_MS", "100"))
+JOB_POLL_INTERVAL_MS = int(getenv("JOB_POLL_INTERVAL_MS", "1000"))
+JOB_LEASE_SECONDS = int(getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(getenv("JOB_MAX_ATTEMPTS", "5"))
+
+_wakeup = asyncio.Event()
+_worker = None
+
+
+async def enqueue_job(job_type, params):
+    now = datetime.utcnow()
+    result = await durable("Jobs", CRITICAL).insert_one({
+        "type": job_type,
+        "params": params,
+        "status": "pending",
+        "progress": {},
+        "attempts": 0,
+        "lockedUntil": now,
+        "createdAt": now,
+        "updatedAt": now
+    })
+    _wakeup.set()
+    return str(result.inserted_id)
+
+
+async def _claim_job():
+    now = datetime.utcnow()
+    return await durable("Jobs", STANDARD).find_one_and_update(
+        {
+            "status": {"$in": ["pending", "running"]},
+            "lockedUntil": {"$lte": now},
+            "attempts": {"$lt": JOB_MAX_ATTEMPTS}
+        },
+        {
+            "$set": {
+                "status": "running",
+                "lockedUntil": now + timedelta(seconds=JOB_LEASE_SECONDS),
+                "updatedAt": now
+            },
+            "$inc": {"attempts": 1}
+        },
+        sort=[("createdAt", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+
+# Records progress, renews the lease so another worker doesn't pick the job up, then throttles.
+async def _report_progress(job, **progress):
+    now = datetime.utcnow()
+    await durable("Jobs", FAST).update_one(
+        {"_id": job["_id"]},
+        {
+            "$inc": {f"progress.{key}": value for key, value in progress.items()},
+            "$set": {"lockedUntil": now + timedelta(seconds=JOB_LEASE_SECONDS), "updatedAt": now}
+        }
+    )
+    await asyncio.sleep(JOB_THROTTLE_MS / 1000)
+
+
+async def _delete_in_chunks(job, delete_chunk, key, progress_key):
+    while True:
+        deleted = await delete_chunk(key, JOB_CHUNK_SIZE)
+        if not deleted:
+            return
+        await _report_progress(job, **{progress_key: deleted})
+
+
+async def _delete_chatroom(job):
+    chatroom_id = ObjectId(job["params"]["chatroom"])
+
+    await _delete_in_chunks(job, delete_chatroom_messages_chunk, chatroom_id, "messagesDeleted")
+    await remove_inbox_chatroom(chatroom_id)
+    await remove_chatroom_memberships(chatroom_id)
+
+
+async def _delete_chatroom_later(chatroom):
+    await durable("Chatrooms", CRITICAL).delete_one({"_id": chatroom["_id"]})
+    await remove_inbox_chatroom(chatroom["_id"])
+    await enqueue_job("deleteChatroom", {"chatroom": str(chatroom["_id"])})
+
+
+async def _remove_user_from_large_chatroom(chatroom, user_id):
+    remaining = await remove_large_member(chatroom, user_id)
+    if remaining is None:
+        return
+    if remaining < 2:
+        return await _delete_chatroom_later(chatroom)
+
+    if chatroom.get("firstMessage", False):
+        chatroom["memberCount"] = remaining
+        await durable("Inbox", STANDARD).delete_one({"chatroom": chatroom["_id"], "user": user_id})
+        await sync_inbox_members(chatroom)
+
+
+async def _remove_user_from_chatroom(chatroom, user_id):
+    if is_large(chatroom):
+        return await _remove_user_from_large_chatroom(chatroom, user_id)
+
+    remaining = [member for member in chatroom.get("members", []) if member != user_id]
+
+    if len(remaining) < 2:
+        return await _delete_chatroom_later(chatroom)
+
+    try:
+        await durable("Chatrooms", CRITICAL).update_one(
+            {"_id": chatroom["_id"]},
+            {
+                "$pull": {"members": user_id},
+                "$set": {"memberKey": chatroom_member_key(remaining)},
+                "$inc": {"version": 1}
+            }
+        )
+    except DuplicateKeyError:
+        await durable("Chatrooms", CRITICAL).update_one(
+            {"_id": chatroom["_id"]},
+            {"$pull": {"members": user_id}, "$unset": {"memberKey": ""}, "$inc": {"version": 1}}
+        )
+
+    if chatroom.get("firstMessage", False):
+        chatroom["members"] = remaining
+        await sync_inbox_members(chatroom)
+
+
+async def _delete_user(job):
+    user_id = ObjectId(job["params"]["user"])
+
+    await _delete_in_chunks(job, delete_sender_messages_chunk, user_id, "messagesDeleted")
+
+    while True:
+        chatrooms = await db["Chatrooms"].find(
+            await member_filter(user_id), {"members": 1, "firstMessage": 1, "largeRoom": 1, "memberCount": 1}
+        ).limit(JOB_CHUNK_SIZE).to_list(None)
+        if not chatrooms:
+            break
+        for chatroom in chatrooms:
+            await _remove_user_from_chatroom(chatroom, user_id)
+        await _report_progress(job, chatroomsUpdated=len(chatrooms))
+
+    await durable("Inbox", STANDARD).delete_many({"user": user_id})
+    await durable("RefreshTokens", CRITICAL).delete_many({"user": user_id})
+
+
+JOB_HANDLERS = {
+    "deleteChatroom": _delete_chatroom,
+    "deleteUser": _delete_user,
+}
+
+
+async def _run_job(job):
+    try:
+        await JOB_HANDLERS[job["type"]](job)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        failed = job["attempts"] >= JOB_MAX_ATTEMPTS
+        print(f"Job {job['_id']} ({job['type']}) failed on attempt {job['attempts']}: {e}")
+        await durable("Jobs", STANDARD).update_one(
+            {"_id": job["_id"]},
+            {"$set": {
+                "status": "failed" if failed else "pending",
+                "lastError": str(e),
+                "lockedUntil": datetime.utcnow() + timedelta(seconds=2 ** job["attempts"]),
+                "updatedAt": datetime.utcnow()
+            }}
+        )
+        return
+
+    await durable("Jobs", STANDARD).update_one(
+        {"_id": job["_id"]},
+        {"$set": {"status": "done", "updatedAt": datetime.utcnow()}}
+    )
+    print(f"Job {job['_id']} ({job['type']}) done")
+
+
+async def _job_worker():
+    while True:
+        try:
+            job = await _claim_job()
+        except Exception as e:
+            print(f"Failed to claim job: {e}")
+            job = None
+
+        if job:
+            try:
+                await _run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Failed to record result of job {job['_id']}: {e}")
+            continue
+
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), JOB_POLL_INTERVAL_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_job_worker():
+    global _worker
+    if _worker is None:
+        _worker = asyncio.create_task(_job_worker())
+
+
+async def stop_job_worker():
+    global _worker
+    if _worker is not None:
+        _worker.cancel()
+        try:
+            await _worker
+        except asyncio.CancelledError:
+            pass
+        _worker = None
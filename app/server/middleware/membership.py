@@ -0,0 +1,243 @@
+from datetime import datetime
+from os import getenv
+
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+
+from app.server.database import get_db
+from app.server.middleware.durability import durable, CRITICAL
+from app.server.middleware.utils import chatroom_member_key
+
+
+db = get_db()
+
+# Small chatrooms keep their members in the embedded "members" array. Once a room
+# has more than LARGE_ROOM_THRESHOLD members it is flagged largeRoom, the array is
+# dropped, and membership moves to one Memberships document per (chatroom, user), so
+# checks are indexed point lookups and listings are paginated. memberCount is kept
+# on the chatroom. Large rooms are never moved back.
+LARGE_ROOM_THRESHOLD = int(getenv("LARGE_ROOM_THRESHOLD", "50"))
+MEMBER_PAGE_SIZE = int(getenv("MEMBER_PAGE_SIZE", "100"))
+
+
+def is_large(chatroom):
+    return chatroom.get("largeRoom", False)
+
+
+def member_count(chatroom):
+    return chatroom.get("memberCount", 0) if is_large(chatroom) else len(chatroom.get("members", []))
+
+
+async def is_member(chatroom, user_id):
+    if not is_large(chatroom):
+        return ObjectId(user_id) in chatroom.get("members", [])
+    return await db["Memberships"].find_one(
+        {"chatroom": chatroom["_id"], "user": ObjectId(user_id)}, {"_id": 1}
+    ) is not None
+
+
+# Returns the ids of the given chatrooms that user_id belongs to, with one query for
+# all the large ones.
+async def member_of(chatrooms, user_id):
+    user_oid = ObjectId(user_id)
+    rooms = set()
+    large = []
+    for chatroom in chatrooms:
+        if is_large(chatroom):
+            large.append(chatroom["_id"])
+        elif user_oid in chatroom.get("members", []):
+            rooms.add(chatroom["_id"])
+    if large:
+        memberships = await db["Memberships"].find(
+            {"chatroom": {"$in": large}, "user": user_oid}, {"chatroom": 1}
+        ).to_list(None)
+        rooms.update(membership["chatroom"] for membership in memberships)
+    return rooms
+
+
+async def member_ids(chatroom):
+    if not is_large(chatroom):
+        return list(chatroom.get("members", []))
+    memberships = await db["Memberships"].find(
+        {"chatroom": chatroom["_id"]}, {"user": 1}
+    ).sort("user", 1).to_list(None)
+    return [membership["user"] for membership in memberships]
+
+
+# One page of member ids ordered by id, and the cursor for the next page (or None).
+async def list_members(chatroom, after=None, limit=MEMBER_PAGE_SIZE):
+    if not is_large(chatroom):
+        members = sorted(chatroom.get("members", []))
+        if after:
+            members = [member for member in members if member > ObjectId(after)]
+        page = members[:limit]
+        return page, (str(page[-1]) if len(members) > limit else None)
+
+    query = {"chatroom": chatroom["_id"]}
+    if after:
+        query["user"] = {"$gt": ObjectId(after)}
+    memberships = await db["Memberships"].find(query, {"user": 1}).sort("user", 1).limit(limit + 1).to_list(None)
+    page = [membership["user"] for membership in memberships[:limit]]
+    return page, (str(page[-1]) if len(memberships) > limit else None)
+
+
+# Chatrooms filter matching every room user_id is in, whichever way it is stored.
+# Memberships rows only count for large rooms: a switch that lost its race leaves
+# rows behind for a room that stays small, and there the array is the truth.
+async def member_filter(user_id):
+    user_oid = ObjectId(user_id)
+    memberships = await db["Memberships"].find({"user": user_oid}, {"chatroom": 1}).to_list(None)
+    if not memberships:
+        return {"members": user_oid}
+    return {"$or": [
+        {"members": user_oid},
+        {"_id": {"$in": [membership["chatroom"] for membership in memberships]}, "largeRoom": True}
+    ]}
+
+
+async def _insert_memberships(chatroom_id, members):
+    now = datetime.utcnow()
+    await durable("Memberships", CRITICAL).bulk_write([
+        UpdateOne(
+            {"chatroom": chatroom_id, "user": ObjectId(member)},
+            {"$setOnInsert": {"joinedAt": now}},
+            upsert=True
+        )
+        for member in members
+    ], ordered=False)
+
+
+async def create_large_chatroom(chatroom_id, members):
+    await _insert_memberships(chatroom_id, members)
+    chatroom = {
+        "_id": chatroom_id,
+        "largeRoom": True,
+        "memberCount": len(members),
+        "firstMessage": False,
+        "version": 1
+    }
+    await durable("Chatrooms", CRITICAL).insert_one(chatroom)
+    return chatroom
+
+
+ADD_MEMBER_ATTEMPTS = 5
+
+
+async def _reload(chatroom):
+    fresh = await db["Chatrooms"].find_one({"_id": chatroom["_id"]})
+    if not fresh:
+        return False
+    chatroom.clear()
+    chatroom.update(fresh)
+    return True
+
+
+# Writes a Memberships row for everyone in the array, then flips the room to large
+# storage if nobody changed it meanwhile. The version check means the array is exactly
+# what was copied, so memberCount can be taken from it; the joining user is added
+# afterwards through the large-room path, which counts with $inc.
+async def _move_to_memberships(chatroom):
+    members = chatroom.get("members", [])
+    await _insert_memberships(chatroom["_id"], members)
+    result = await durable("Chatrooms", CRITICAL).update_one(
+        {"_id": chatroom["_id"], "largeRoom": {"$ne": True}, "version": chatroom.get("version")},
+        {
+            "$set": {"largeRoom": True, "memberCount": len(members)},
+            "$unset": {"members": "", "memberKey": ""},
+            "$inc": {"version": 1}
+        }
+    )
+    if result.modified_count == 0:
+        return False
+    chatroom.pop("members", None)
+    chatroom.pop("memberKey", None)
+    chatroom["largeRoom"] = True
+    chatroom["memberCount"] = len(members)
+    chatroom["version"] = chatroom.get("version", 0) + 1
+    return True
+
+
+async def _add_large_member(chatroom, user_oid):
+    result = await durable("Memberships", CRITICAL).update_one(
+        {"chatroom": chatroom["_id"], "user": user_oid},
+        {"$setOnInsert": {"joinedAt": datetime.utcnow()}},
+        upsert=True
+    )
+    if result.upserted_id is None:
+        return False
+    await durable("Chatrooms", CRITICAL).update_one({"_id": chatroom["_id"]}, {"$inc": {"memberCount": 1, "version": 1}})
+    chatroom["memberCount"] = chatroom.get("memberCount", 0) + 1
+    return True
+
+
+# Adds user_id to the chatroom, moving it to Memberships if it outgrows the array.
+# Updates the passed chatroom in place and returns False if nothing changed. Raises
+# DuplicateKeyError if a small room would end up with the same members as another.
+# Small-room writes are conditional on the version that was read, so concurrent joins
+# can't both derive memberKey from the same stale member list; the loser reloads.
+async def add_member(chatroom, user_id):
+    user_oid = ObjectId(user_id)
+
+    for _ in range(ADD_MEMBER_ATTEMPTS):
+        if is_large(chatroom):
+            return await _add_large_member(chatroom, user_oid)
+
+        if user_oid in chatroom.get("members", []):
+            return False
+        members = chatroom.get("members", []) + [user_oid]
+        if len(members) > LARGE_ROOM_THRESHOLD:
+            if await _move_to_memberships(chatroom):
+                return await _add_large_member(chatroom, user_oid)
+            if not await _reload(chatroom):
+                return False
+            if not is_large(chatroom):
+                # The room changed before the switch; drop rows copied for anyone who
+                # has since left it.
+                await durable("Memberships", CRITICAL).delete_many(
+                    {"chatroom": chatroom["_id"], "user": {"$nin": chatroom.get("members", [])}}
+                )
+            continue
+
+        result = await durable("Chatrooms", CRITICAL).update_one(
+            {"_id": chatroom["_id"], "largeRoom": {"$ne": True}, "version": chatroom.get("version")},
+            {
+                "$addToSet": {"members": user_oid},
+                "$set": {"memberKey": chatroom_member_key(members)},
+                "$inc": {"version": 1}
+            }
+        )
+        if result.modified_count == 1:
+            chatroom["members"] = members
+            chatroom["version"] = chatroom.get("version", 0) + 1
+            return True
+        if not await _reload(chatroom):
+            return False
+
+    return False
+
+
+# Removes user_id from a large room and returns how many members are left, or None
+# if they weren't a member.
+async def remove_large_member(chatroom, user_id):
+    result = await durable("Memberships", CRITICAL).delete_one({"chatroom": chatroom["_id"], "user": ObjectId(user_id)})
+    if result.deleted_count == 0:
+        return None
+    updated = await durable("Chatrooms", CRITICAL).find_one_and_update(
+        {"_id": chatroom["_id"]},
+        {"$inc": {"memberCount": -1, "version": 1}},
+        projection={"memberCount": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    return updated["memberCount"] if updated else 0
+
+
+async def remove_chatroom_memberships(chatroom_id):
+    await durable("Memberships", CRITICAL).delete_many({"chatroom": ObjectId(chatroom_id)})
+
+
+async def large_room_name(chatroom):
+    first_members, _ = await list_members(chatroom, limit=3)
+    users = await db["Users"].find({"_id": {"$in": first_members}}, {"username": 1}).to_list(None)
+    names = [user.get("username", "Unknown") for user in users]
+    others = member_count(chatroom) - len(names)
+    return f"{', '.join(names)} and {others} others" if others > 0 else ", ".join(names) or "Unnamed Chatroom"
@@ -0,0 +1,168 @@
+import asyncio
+import os
+import threading
+import tracemalloc
+from datetime import datetime
+from os import getenv
+
+from app.server.middleware.metrics import register_gauge
+from app.server.middleware.socket import BINARY_SUFFIX, socket_manager
+
+
+# Tracing every allocation slows the worker down, so tracemalloc only runs between a
+# POST /api/admin/memory/baseline and a DELETE of the tracing (or from start-up with
+# MEMORY_TRACE_ON_START=1). TRACEMALLOC_FRAMES frames are kept per allocation, enough
+# to tell engine.io state from room bookkeeping from a to_list() in a route.
+TRACEMALLOC_FRAMES = int(getenv("TRACEMALLOC_FRAMES", "10"))
+MEMORY_TRACE_ON_START = getenv("MEMORY_TRACE_ON_START", "0") == "1"
+
+GROUP_BY = ("lineno", "filename", "traceback")
+
+# Allocations made by tracemalloc itself and by importing modules are never the leak.
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _format_stat(stat, group_by):
+    # Most recent frame first, i.e. the line that allocated.
+    frames = list(reversed(stat.traceback))
+    if group_by != "traceback":
+        frames = frames[:1]
+    entry = {
+        "size": stat.size,
+        "count": stat.count,
+        "site": [f"{frame.filename}:{frame.lineno}" for frame in frames],
+    }
+    if isinstance(stat, tracemalloc.StatisticDiff):
+        entry["sizeDiff"] = stat.size_diff
+        entry["countDiff"] = stat.count_diff
+    return entry
+
+
+class MemoryProfiler:
+    def __init__(self, frames=TRACEMALLOC_FRAMES):
+        self.frames = frames
+        self._lock = threading.Lock()
+        self._baseline = None
+        self._baseline_at = None
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self):
+        with self._lock:
+            self._baseline = None
+            self._baseline_at = None
+        tracemalloc.stop()
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+    def _set_baseline(self):
+        self.start()
+        snapshot = self._snapshot()
+        with self._lock:
+            self._baseline = snapshot
+            self._baseline_at = datetime.utcnow()
+
+    def _top(self, limit, group_by):
+        stats = self._snapshot().statistics(group_by)
+        return [_format_stat(stat, group_by) for stat in stats[:limit]]
+
+    def _diff(self, limit, group_by):
+        with self._lock:
+            baseline = self._baseline
+        if baseline is None:
+            return None
+        stats = self._snapshot().compare_to(baseline, group_by)
+        return [_format_stat(stat, group_by) for stat in stats[:limit]]
+
+    # Snapshots and comparisons walk every traced block, so they run off the loop.
+    async def set_baseline(self):
+        await asyncio.to_thread(self._set_baseline)
+
+    async def top(self, limit=20, group_by="lineno"):
+        if not self.tracing:
+            return None
+        return await asyncio.to_thread(self._top, limit, group_by)
+
+    async def diff(self, limit=20, group_by="lineno"):
+        if not self.tracing:
+            return None
+        return await asyncio.to_thread(self._diff, limit, group_by)
+
+    def status(self):
+        traced = tracemalloc.get_traced_memory() if self.tracing else (0, 0)
+        return {
+            "tracing": self.tracing,
+            "frames": tracemalloc.get_traceback_limit() if self.tracing else self.frames,
+            "tracedBytes": traced[0],
+            "tracedPeakBytes": traced[1],
+            "tracemallocOverheadBytes": tracemalloc.get_tracemalloc_memory() if self.tracing else 0,
+            "baselineAt": self._baseline_at,
+        }
+
+
+memory_profiler = MemoryProfiler()
+
+
+# What the socket layer is holding on to. Each connected socket should account for one
+# engine.io socket, one environ, one session and one personal room, so any of these
+# pulling away from "connected" points at state that isn't released on disconnect.
+def socket_stats():
+    sio = socket_manager._sio
+    namespace = sio.manager.rooms.get("/", {})
+    connected = namespace.get(None, {})
+
+    rooms = 0
+    binary_rooms = 0
+    room_memberships = 0
+    for name, members in namespace.items():
+        if name is None or name in connected:
+            continue
+        rooms += 1
+        room_memberships += len(members)
+        if name.endswith(BINARY_SUFFIX):
+            binary_rooms += 1
+
+    return {
+        "engineioSockets": len(sio.eio.sockets),
+        "connected": len(connected),
+        "sessions": sum(1 for socket in list(sio.eio.sockets.values()) if socket.session),
+        "environs": len(sio.environ),
+        "rooms": rooms,
+        "binaryRooms": binary_rooms,
+        "roomMemberships": room_memberships,
+        "pendingDisconnects": sum(len(sids) for sids in sio.manager.pending_disconnect.values()),
+        "pendingCallbacks": sum(len(callbacks) for callbacks in sio.manager.callbacks.values()),
+    }
+
+
+def memory_report():
+    return {
+        "rssBytes": rss_bytes(),
+        "tracemalloc": memory_profiler.status(),
+        "sockets": socket_stats(),
+    }
+
+
+register_gauge("process_resident_memory_bytes", lambda: rss_bytes() or 0)
+register_gauge("socket_engineio_sockets", lambda: len(socket_manager._sio.eio.sockets))
+register_gauge("socket_rooms", lambda: socket_stats()["rooms"])
@@ -0,0 +1,224 @@
+from datetime import datetime, timezone
+from os import getenv
+from pymongo import DeleteMany, UpdateMany, UpdateOne
+
+from app.server.database import get_db
+from app.server.middleware.durability import durable, STANDARD, FAST
+
+
+db = get_db()
+
+# Messages are stored either one document per message ("documents", the default) or
+# packed into per-chatroom time buckets ("buckets"). Bucket documents look like
+#   {chatroom, start, count, messages: [{_id, sender, message, readBy}]}
+# and hold at most BUCKET_MAX_MESSAGES messages sent within BUCKET_SPAN_SECONDS.
+# Every read returns the per-message shape, so callers don't depend on the mode.
+MESSAGE_STORAGE = getenv("MESSAGE_STORAGE", "documents")
+BUCKETED = MESSAGE_STORAGE == "buckets"
+BUCKET_MAX_MESSAGES = int(getenv("BUCKET_MAX_MESSAGES", "200"))
+BUCKET_SPAN_SECONDS = int(getenv("BUCKET_SPAN_SECONDS", "3600"))
+
+MESSAGES = "Messages"
+BUCKETS = "MessageBuckets"
+
+
+async def init_message_indexes():
+    if BUCKETED:
+        await db[BUCKETS].create_index([("chatroom", 1), ("start", 1), ("count", 1)])
+        await db[BUCKETS].create_index("messages._id")
+        await db[BUCKETS].create_index("messages.sender")
+    else:
+        await db[MESSAGES].create_index([("chatroom", 1), ("_id", 1)])
+        await db[MESSAGES].create_index("sender")
+
+
+def _bucket_start(message_id):
+    created = message_id.generation_time.timestamp()
+    return datetime.fromtimestamp(created - created % BUCKET_SPAN_SECONDS, tz=timezone.utc)
+
+
+def _bucket_entry(document):
+    return {
+        "_id": document["_id"],
+        "sender": document["sender"],
+        "message": document["message"],
+        "readBy": document.get("readBy", [])
+    }
+
+
+async def insert_messages(documents):
+    if not BUCKETED:
+        if len(documents) == 1:
+            await durable(MESSAGES, STANDARD).insert_one(documents[0])
+        else:
+            await durable(MESSAGES, STANDARD).insert_many(documents)
+        return
+
+    groups = {}
+    for document in documents:
+        key = (document["chatroom"], _bucket_start(document["_id"]))
+        groups.setdefault(key, []).append(_bucket_entry(document))
+
+    operations = []
+    for (chatroom_id, start), entries in groups.items():
+        for offset in range(0, len(entries), BUCKET_MAX_MESSAGES):
+            chunk = entries[offset:offset + BUCKET_MAX_MESSAGES]
+            operations.append(UpdateOne(
+                {"chatroom": chatroom_id, "start": start, "count": {"$lte": BUCKET_MAX_MESSAGES - len(chunk)}},
+                {"$push": {"messages": {"$each": chunk}}, "$inc": {"count": len(chunk)}},
+                upsert=True
+            ))
+    await durable(BUCKETS, STANDARD).bulk_write(operations, ordered=True)
+
+
+def _unwind_unread(user_id):
+    return [
+        {"$match": {"messages": {"$elemMatch": {"readBy": {"$ne": user_id}}}}},
+        {"$sort": {"start": 1}},
+        {"$unwind": "$messages"},
+        {"$match": {"messages.readBy": {"$ne": user_id}}},
+        {"$replaceRoot": {"newRoot": {"$mergeObjects": ["$messages", {"chatroom": "$chatroom"}]}}}
+    ]
+
+
+async def find_unread(chatroom_id, user_id, limit):
+    if not BUCKETED:
+        return await db[MESSAGES].find({
+            "chatroom": chatroom_id,
+            "readBy": {"$ne": user_id}
+        }).sort("_id", 1).to_list(limit)
+
+    return await db[BUCKETS].aggregate(
+        [{"$match": {"chatroom": chatroom_id}}] + _unwind_unread(user_id) + [{"$limit": limit}]
+    ).to_list(None)
+
+
+# $lookup stage joining each chatroom to its unread messages for user_id, as
+# {"messages": [...], "count": [{"total": n}]} in the "unread" field.
+def unread_lookup_stage(user_id, limit):
+    facet = {"$facet": {
+        "messages": [{"$limit": limit}],
+        "count": [{"$count": "total"}]
+    }}
+    if not BUCKETED:
+        return {"$lookup": {
+            "from": MESSAGES,
+            "localField": "_id",
+            "foreignField": "chatroom",
+            "pipeline": [
+                {"$match": {"readBy": {"$ne": user_id}}},
+                {"$sort": {"_id": 1}},
+                facet
+            ],
+            "as": "unread"
+        }}
+
+    return {"$lookup": {
+        "from": BUCKETS,
+        "localField": "_id",
+        "foreignField": "chatroom",
+        "pipeline": _unwind_unread(user_id) + [facet],
+        "as": "unread"
+    }}
+
+
+async def find_read_state(message_ids):
+    if not BUCKETED:
+        return await db[MESSAGES].find(
+            {"_id": {"$in": message_ids}}, {"chatroom": 1, "readBy": 1}
+        ).to_list(None)
+
+    return await db[BUCKETS].aggregate([
+        {"$match": {"messages._id": {"$in": message_ids}}},
+        {"$unwind": "$messages"},
+        {"$match": {"messages._id": {"$in": message_ids}}},
+        {"$project": {"_id": "$messages._id", "chatroom": 1, "readBy": "$messages.readBy"}}
+    ]).to_list(None)
+
+
+async def latest_message_id(chatroom_id):
+    if not BUCKETED:
+        message = await db[MESSAGES].find_one({"chatroom": chatroom_id}, {"_id": 1}, sort=[("_id", -1)])
+        return message["_id"] if message else None
+
+    bucket = await db[BUCKETS].find_one(
+        {"chatroom": chatroom_id, "messages.0": {"$exists": True}},
+        {"messages": {"$slice": -1}},
+        sort=[("start", -1)]
+    )
+    return bucket["messages"][-1]["_id"] if bucket else None
+
+
+async def existing_message_ids(message_ids):
+    return {message["_id"] for message in await find_read_state(message_ids)}
+
+
+# newly_read maps (user_id, chatroom_id) to the message ids that user has just read.
+async def add_readers(newly_read):
+    if not BUCKETED:
+        await durable(MESSAGES, FAST).bulk_write([
+            UpdateMany({"_id": {"$in": ids}}, {"$addToSet": {"readBy": user_id}})
+            for (user_id, _), ids in newly_read.items()
+        ], ordered=False)
+        return
+
+    await durable(BUCKETS, FAST).bulk_write([
+        UpdateMany(
+            {"chatroom": chatroom_id, "messages._id": {"$in": ids}},
+            {"$addToSet": {"messages.$[read].readBy": user_id}},
+            array_filters=[{"read._id": {"$in": ids}}]
+        )
+        for (user_id, chatroom_id), ids in newly_read.items()
+    ], ordered=False)
+
+
+# readers maps each chatroom to (message_ids, user ids that must all have read them).
+# The check is part of the delete filter, so a message is
+# only removed if it is fully read at the moment of the delete, whatever snapshot the
+# caller decided from.
+async def delete_read_messages(readers):
+    if not BUCKETED:
+        await durable(MESSAGES, FAST).bulk_write([
+            DeleteMany({"_id": {"$in": ids}, "chatroom": chatroom_id, "readBy": {"$all": members}})
+            for chatroom_id, (ids, members) in readers.items()
+        ], ordered=False)
+        return
+
+    await durable(BUCKETS, FAST).bulk_write([
+        UpdateMany(
+            {"chatroom": chatroom_id, "messages._id": {"$in": ids}},
+            {"$pull": {"messages": {"_id": {"$in": ids}, "readBy": {"$all": members}}}}
+        )
+        for chatroom_id, (ids, members) in readers.items()
+    ], ordered=False)
+    await durable(BUCKETS, FAST).delete_many({"chatroom": {"$in": list(readers)}, "messages": {"$size": 0}})
+
+
+# Deletes up to limit documents (messages or buckets) for a chatroom, returning how many went.
+async def delete_chatroom_messages_chunk(chatroom_id, limit):
+    collection = BUCKETS if BUCKETED else MESSAGES
+    chunk = await db[collection].find({"chatroom": chatroom_id}, {"_id": 1}).limit(limit).to_list(None)
+    if not chunk:
+        return 0
+    result = await durable(collection, STANDARD).delete_many({"_id": {"$in": [doc["_id"] for doc in chunk]}})
+    return result.deleted_count
+
+
+async def delete_sender_messages_chunk(sender_id, limit):
+    if not BUCKETED:
+        chunk = await db[MESSAGES].find({"sender": sender_id}, {"_id": 1}).limit(limit).to_list(None)
+        if not chunk:
+            return 0
+        result = await durable(MESSAGES, STANDARD).delete_many({"_id": {"$in": [doc["_id"] for doc in chunk]}})
+        return result.deleted_count
+
+    chunk = await db[BUCKETS].find({"messages.sender": sender_id}, {"_id": 1}).limit(limit).to_list(None)
+    if not chunk:
+        return 0
+    bucket_ids = [doc["_id"] for doc in chunk]
+    result = await durable(BUCKETS, STANDARD).update_many(
+        {"_id": {"$in": bucket_ids}},
+        {"$pull": {"messages": {"sender": sender_id}}}
+    )
+    await durable(BUCKETS, STANDARD).delete_many({"_id": {"$in": bucket_ids}, "messages": {"$size": 0}})
+    return result.modified_count
@@ -0,0 +1,40 @@
+import threading
+
+# Process-local counters and gauges, rendered in the Prometheus text format by
+# GET /api/admin/metrics. Counters may be bumped from driver threads, hence the lock.
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def increment(name, labels=None, amount=1):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def register_gauge(name, read, labels=None):
+    _gauges[_key(name, labels)] = read
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(name, labels, value):
+    if labels:
+        rendered = ",".join(f'{label}="{_escape(label_value)}"' for label, label_value in labels)
+        return f"{name}{{{rendered}}} {value}"
+    return f"{name} {value}"
+
+
+def render_metrics():
+    with _lock:
+        counters = dict(_counters)
+    lines = [_format(name, labels, value) for (name, labels), value in sorted(counters.items())]
+    lines += [_format(name, labels, read()) for (name, labels), read in sorted(_gauges.items(), key=lambda item: item[0])]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,62 @@
+import asyncio
+from os import getenv
+
+from app.server.middleware.metrics import increment
+from app.server.middleware.socket import emit_event, room_size
+from app.server.middleware.tasks import background_tasks
+
+
+PRESENCE_WINDOW_MS = int(getenv("PRESENCE_WINDOW_MS", "500"))
+PRESENCE_ROOM_THRESHOLD = int(getenv("PRESENCE_ROOM_THRESHOLD", "20"))
+
+JOINED = "joined"
+LEFT = "left"
+
+
+# Join/leave notifications for rooms with at least PRESENCE_ROOM_THRESHOLD sockets are
+# buffered for PRESENCE_WINDOW_MS and sent as one presenceDigest per room and window.
+# Only each user's net change goes out: a leave followed by a join (a reconnect) or a
+# join followed by a leave within the window cancel out. Smaller rooms keep getting
+# one "notification" per join/leave as before.
+class NotificationCoalescer:
+    def __init__(self, window_ms=PRESENCE_WINDOW_MS, room_threshold=PRESENCE_ROOM_THRESHOLD):
+        self.window = window_ms / 1000
+        self.room_threshold = room_threshold
+        self._pending = {}
+        self._timers = {}
+
+    async def notify(self, room, user_id, action):
+        room = str(room)
+        if room not in self._pending and room_size(room) < self.room_threshold:
+            increment("presence_notifications_total", {"mode": "immediate"})
+            message = f"User {user_id} joined the chatroom" if action == JOINED else f"User {user_id} left chatroom {room}"
+            await emit_event("notification", {"message": message}, room=room, binary=False)
+            return
+
+        increment("presence_notifications_total", {"mode": "coalesced"})
+        changes = self._pending.setdefault(room, {})
+        first, _ = changes.get(str(user_id), (action, action))
+        changes[str(user_id)] = (first, action)
+        if room not in self._timers:
+            self._timers[room] = asyncio.get_running_loop().call_later(self.window, self._flush, room)
+
+    def _flush(self, room):
+        self._timers.pop(room, None)
+        changes = self._pending.pop(room, {})
+        joined = [user_id for user_id, (first, last) in changes.items() if first == last == JOINED]
+        left = [user_id for user_id, (first, last) in changes.items() if first == last == LEFT]
+        if not joined and not left:
+            return
+        increment("presence_digests_total")
+        background_tasks.submit("presenceDigest", emit_event(
+            "presenceDigest", {"chatroom": room, "joined": joined, "left": left}, room=room, binary=False
+        ))
+
+    def stop(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._pending.clear()
+
+
+presence = NotificationCoalescer()
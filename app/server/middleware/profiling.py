@@ -0,0 +1,161 @@
+import asyncio
+import cProfile
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+from os import getenv, makedirs, path
+from weakref import WeakKeyDictionary
+from starlette.routing import Match
+
+from app.server.middleware.admin import is_admin_token
+
+
+PROFILE_DIR = getenv("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = float(getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_EVENTS = {name for name in getenv("PROFILE_EVENTS", "").split(",") if name}
+LOOP_LAG_THRESHOLD_MS = float(getenv("LOOP_LAG_THRESHOLD_MS", "100"))
+LOOP_LAG_INTERVAL_MS = float(getenv("LOOP_LAG_INTERVAL_MS", "50"))
+
+current_operation = ContextVar("current_operation", default=None)
+_task_operations = WeakKeyDictionary()
+_profiling = False
+
+
+def route_label(scope):
+    if "route_label" in scope:
+        return scope["route_label"]
+    # Raw paths would give every scanner probe and 404 its own metric series.
+    label = f"{scope.get('method', 'WS')} <unmatched>"
+    for route in getattr(scope.get("app"), "routes", []):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            label = f"{scope.get('method', 'WS')} {route.path}"
+            break
+    scope["route_label"] = label
+    return label
+
+
+def set_operation(label):
+    current_operation.set(label)
+    task = asyncio.current_task()
+    if task is not None:
+        _task_operations[task] = label
+
+
+# cProfile sees every coroutine resumed on the loop thread while it is enabled,
+# so concurrent requests can show up in a profile. Only one runs at a time.
+async def _run_profiled(label, coro):
+    global _profiling
+    _profiling = True
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        return await coro
+    finally:
+        profile.disable()
+        _profiling = False
+        makedirs(PROFILE_DIR, exist_ok=True)
+        filename = f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{re.sub(r'[^A-Za-z0-9]+', '_', label).strip('_')}.prof"
+        profile.dump_stats(path.join(PROFILE_DIR, filename))
+        print(f"Profile for {label} written to {filename}")
+
+
+def _sampled():
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        label = route_label(scope)
+        set_operation(label)
+
+        headers = dict(scope.get("headers", []))
+        requested = is_admin_token(headers.get(b"x-profile", b"").decode("latin-1"))
+        if not _profiling and (requested or _sampled()):
+            return await _run_profiled(label, self.app(scope, receive, send))
+        return await self.app(scope, receive, send)
+
+
+def instrument_event(event):
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(*args):
+            label = f"socket {event}"
+            set_operation(label)
+            if not _profiling and (not PROFILE_EVENTS or event in PROFILE_EVENTS) and _sampled():
+                return await _run_profiled(label, handler(*args))
+            return await handler(*args)
+        return wrapper
+    return decorator
+
+
+# Heartbeat on the event loop, watched from a thread so a blocked loop can still be reported.
+class LoopLagMonitor:
+    def __init__(self, threshold_ms=LOOP_LAG_THRESHOLD_MS, interval_ms=LOOP_LAG_INTERVAL_MS):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.lag = 0.0
+        self._beat = time.monotonic()
+        self._loop = None
+        self._loop_thread_id = None
+        self._heartbeat = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    async def _run_heartbeat(self):
+        while True:
+            started = time.monotonic()
+            self._beat = started
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, time.monotonic() - started - self.interval)
+
+    def _watch(self):
+        stalled = None
+        while not self._stopped.wait(self.interval):
+            blocked = time.monotonic() - self._beat - self.interval
+            if blocked > self.threshold and stalled is None:
+                task = asyncio.current_task(self._loop)
+                stalled = _task_operations.get(task, "unknown") if task else "loop callback"
+                frame = sys._current_frames().get(self._loop_thread_id)
+                stack = "".join(traceback.format_stack(frame, limit=8)) if frame else ""
+                print(f"Event loop blocked for over {blocked * 1000:.0f}ms in {stalled}\n{stack}")
+            elif blocked <= self.threshold and stalled is not None:
+                print(f"Event loop unblocked after {self.lag * 1000:.0f}ms lag in {stalled}")
+                stalled = None
+
+    def start(self):
+        if self._heartbeat is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stopped.clear()
+        self._heartbeat = asyncio.create_task(self._run_heartbeat())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-lag-monitor", daemon=True)
+        self._watchdog.start()
+
+    async def stop(self):
+        if self._heartbeat is None:
+            return
+        self._stopped.set()
+        self._heartbeat.cancel()
+        try:
+            await self._heartbeat
+        except asyncio.CancelledError:
+            pass
+        self._heartbeat = None
+
+
+loop_lag_monitor = LoopLagMonitor()
@@ -0,0 +1,165 @@
+import asyncio
+from os import getenv
+
+from app.server.database import get_db
+from app.server.middleware.inbox import mark_inbox_read
+from app.server.middleware.membership import is_large, member_ids
+from app.server.middleware.message_store import find_read_state, add_readers, delete_read_messages
+
+
+db = get_db()
+
+READ_RECEIPT_FLUSH_MS = int(getenv("READ_RECEIPT_FLUSH_MS", "250"))
+READ_RECEIPT_MAX_PENDING = int(getenv("READ_RECEIPT_MAX_PENDING", "5000"))
+READ_RECEIPT_DURABLE = getenv("READ_RECEIPT_DURABLE", "1") == "1"
+
+
+# Large rooms don't carry their member list, so there a message is only worth checking
+# against Memberships once it has at least as many readers as the room has members.
+# The count alone isn't enough: readers who have since left stay in readBy.
+def may_be_read_by_everyone(chatroom, message):
+    if is_large(chatroom):
+        return len(set(message.get("readBy", []))) >= chatroom.get("memberCount", 0)
+    return set(map(str, chatroom["members"])) <= set(message.get("readBy", []))
+
+
+# Buffers read receipts in memory and writes them on a short interval. Receipts are
+# merged per (user, chatroom) so a burst of PUT /api/message/read calls becomes one
+# bulk_write. With READ_RECEIPT_DURABLE the buffer is flushed before shutdown.
+class ReadReceiptBuffer:
+    def __init__(self, interval_ms=READ_RECEIPT_FLUSH_MS, max_pending=READ_RECEIPT_MAX_PENDING, durable=READ_RECEIPT_DURABLE):
+        self.interval = interval_ms / 1000
+        self.max_pending = max_pending
+        self.durable = durable
+        self._pending = {}
+        self._pending_count = 0
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = None
+
+    def add(self, user_id, message_ids):
+        receipts = self._pending.setdefault(str(user_id), set())
+        before = len(receipts)
+        receipts.update(message_ids)
+        self._pending_count += len(receipts) - before
+        if self._pending_count >= self.max_pending:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._lock:
+            pending, self._pending, self._pending_count = self._pending, {}, 0
+            if not pending:
+                return
+            try:
+                await self._write(pending)
+            except Exception as e:
+                print(f"Failed to flush read receipts, retrying next interval: {e}")
+                self._requeue(pending)
+
+    # Puts receipts that failed to write back with any added since. While the database
+    # is down this would grow on every interval, so past max_pending the oldest
+    # messages' receipts are dropped; clients mark them read again on their next fetch.
+    def _requeue(self, pending):
+        newer, self._pending, self._pending_count = self._pending, {}, 0
+        for receipts in (pending, newer):
+            for user_id, message_ids in receipts.items():
+                self.add(user_id, message_ids)
+
+        overflow = self._pending_count - self.max_pending
+        if overflow <= 0:
+            return
+        receipts = sorted(
+            (message_id, user_id)
+            for user_id, message_ids in self._pending.items()
+            for message_id in message_ids
+        )
+        for message_id, user_id in receipts[:overflow]:
+            self._pending[user_id].discard(message_id)
+            if not self._pending[user_id]:
+                del self._pending[user_id]
+        self._pending_count -= overflow
+        print(f"Dropped {overflow} read receipts over READ_RECEIPT_MAX_PENDING ({self.max_pending})")
+
+    async def _write(self, pending):
+        message_ids = list(set().union(*pending.values()))
+        messages = await find_read_state(message_ids)
+        messages = {message["_id"]: message for message in messages}
+
+        newly_read = {}
+        for user_id, user_message_ids in pending.items():
+            for message_id in user_message_ids:
+                message = messages.get(message_id)
+                if not message or user_id in message.setdefault("readBy", []):
+                    continue
+                message["readBy"].append(user_id)
+                newly_read.setdefault((user_id, message["chatroom"]), []).append(message_id)
+
+        if not newly_read:
+            return
+
+        await add_readers(newly_read)
+
+        await mark_inbox_read({key: len(ids) for key, ids in newly_read.items()})
+
+        chatroom_ids = list({chatroom_id for _, chatroom_id in newly_read})
+        chatrooms = await db["Chatrooms"].find(
+            {"_id": {"$in": chatroom_ids}}, {"members": 1, "largeRoom": 1, "memberCount": 1}
+        ).to_list(None)
+        chatrooms = {chatroom["_id"]: chatroom for chatroom in chatrooms}
+
+        # Re-read after our readers landed: another worker flushing receipts for the
+        # same messages may have added the rest, and one of us has to see them all.
+        updated_ids = list({message_id for ids in newly_read.values() for message_id in ids})
+        candidates = {}
+        for message in await find_read_state(updated_ids):
+            chatroom = chatrooms.get(message["chatroom"])
+            if chatroom and may_be_read_by_everyone(chatroom, message):
+                candidates.setdefault(message["chatroom"], []).append(message)
+
+        to_delete = {}
+        for chatroom_id, room_messages in candidates.items():
+            members = [str(member) for member in await member_ids(chatrooms[chatroom_id])]
+            ids = [message["_id"] for message in room_messages if set(members) <= set(message.get("readBy", []))]
+            if members and ids:
+                to_delete[chatroom_id] = (ids, members)
+        if to_delete:
+            await delete_read_messages(to_delete)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+
+        if self.durable:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            await self.flush()
+            if self._pending_count:
+                print(f"Lost {self._pending_count} read receipts that could not be flushed on shutdown")
+        else:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            if self._pending_count:
+                print(f"Dropping {self._pending_count} buffered read receipts on shutdown")
+        self._task = None
+
+
+read_receipts = ReadReceiptBuffer()
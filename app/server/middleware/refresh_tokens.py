@@ -0,0 +1,82 @@
+import hashlib
+import secrets
+from datetime import datetime, timedelta
+from os import getenv
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from app.server.database import get_db
+from app.server.middleware.durability import durable, CRITICAL
+
+
+db = get_db()
+
+REFRESH_TOKEN_DAYS = int(getenv("REFRESH_TOKEN_DAYS", "30"))
+
+# Refresh tokens are opaque random strings; only their sha256 is stored, as the _id,
+# so a refresh is a single primary-key lookup. Every token belongs to a family that
+# starts at login. Refreshing revokes the presented token and issues the next one in
+# the family, and presenting an already revoked token revokes the whole family, since
+# that means the token was copied.
+
+
+def _token_id(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+async def issue_refresh_token(user_id, family=None):
+    token = secrets.token_urlsafe(32)
+    now = datetime.utcnow()
+    await durable("RefreshTokens", CRITICAL).insert_one({
+        "_id": _token_id(token),
+        "user": ObjectId(user_id),
+        "family": family or ObjectId(),
+        "revoked": False,
+        "createdAt": now,
+        "expiresAt": now + timedelta(days=REFRESH_TOKEN_DAYS)
+    })
+    return token
+
+
+# Returns (user_id, next_token), or None if the token is unknown, expired or revoked.
+async def rotate_refresh_token(token: str):
+    token_id = _token_id(token)
+    now = datetime.utcnow()
+    current = await durable("RefreshTokens", CRITICAL).find_one_and_update(
+        {"_id": token_id, "revoked": False, "expiresAt": {"$gt": now}},
+        {"$set": {"revoked": True, "revokedAt": now}},
+        projection={"user": 1, "family": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if current:
+        next_token = await issue_refresh_token(current["user"], current["family"])
+        return str(current["user"]), next_token
+
+    reused = await db["RefreshTokens"].find_one({"_id": token_id, "revoked": True}, {"family": 1, "user": 1})
+    if reused:
+        print(f"Refresh token reuse detected for user {reused['user']}, revoking its family")
+        await revoke_family(reused["family"])
+    return None
+
+
+async def revoke_family(family):
+    await durable("RefreshTokens", CRITICAL).update_many(
+        {"family": family, "revoked": False},
+        {"$set": {"revoked": True, "revokedAt": datetime.utcnow()}}
+    )
+
+
+async def revoke_refresh_token(token: str):
+    current = await db["RefreshTokens"].find_one({"_id": _token_id(token)}, {"family": 1})
+    if not current:
+        return False
+    await revoke_family(current["family"])
+    return True
+
+
+async def revoke_user_tokens(user_id):
+    await durable("RefreshTokens", CRITICAL).update_many(
+        {"user": ObjectId(user_id), "revoked": False},
+        {"$set": {"revoked": True, "revokedAt": datetime.utcnow()}}
+    )
@@ -0,0 +1,181 @@
+import json
+import threading
+from datetime import datetime
+from os import getenv
+
+from bson import json_util
+from pymongo import monitoring
+
+from app.server.middleware.metrics import increment
+from app.server.middleware.profiling import current_operation
+from app.server.middleware.tasks import background_tasks
+
+
+SLOW_QUERY_MS = float(getenv("SLOW_QUERY_MS", "100"))
+SLOW_QUERY_MAX_SHAPES = int(getenv("SLOW_QUERY_MAX_SHAPES", "500"))
+SLOW_QUERY_EXPLAIN = getenv("SLOW_QUERY_EXPLAIN", "1") == "1"
+
+# Where each command keeps the part that decides its plan.
+QUERY_FIELDS = {
+    "find": ("filter", "sort", "projection"),
+    "aggregate": ("pipeline",),
+    "count": ("query",),
+    "distinct": ("key", "query"),
+    "findAndModify": ("query", "sort"),
+    "update": ("updates",),
+    "delete": ("deletes",),
+}
+EXPLAINABLE = set(QUERY_FIELDS)
+# Fields the driver adds to each command that explain must not be given.
+SESSION_FIELDS = {
+    "lsid", "txnNumber", "$clusterTime", "$db", "$readPreference", "autocommit", "startTransaction", "maxTimeMS",
+    "writeConcern", "ordered",
+}
+IGNORED_COMMANDS = {"explain", "hello", "isMaster", "ismaster", "ping", "saslStart", "saslContinue", "endSessions"}
+
+
+# Replaces every literal with its type so queries that differ only in values share a
+# shape, e.g. {"chatroom": ObjectId(...), "readBy": {"$ne": "abc"}} becomes
+# {"chatroom": "<ObjectId>", "readBy": {"$ne": "<str>"}}.
+def normalize(value):
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = []
+        for item in value:
+            shape = normalize(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return f"<{type(value).__name__}>"
+
+
+def command_shape(command_name, command):
+    # getMore carries the cursor id where other commands name the collection.
+    collection = command.get("collection") if command_name == "getMore" else command.get(command_name)
+    shape = {"command": command_name, "collection": collection}
+    for field in QUERY_FIELDS.get(command_name, ()):
+        if field not in command:
+            continue
+        if field in ("updates", "deletes"):
+            shape[field] = normalize([statement.get("q", {}) for statement in command[field]])
+        elif field == "key":
+            shape[field] = command[field]
+        elif field in ("sort", "projection"):
+            shape[field] = list(command[field])
+        else:
+            shape[field] = normalize(command[field])
+    return shape
+
+
+def _shape_key(shape):
+    return repr(shape)
+
+
+# Drops server noise and turns BSON values (ObjectIds in parsed filters) into plain JSON.
+def _trim_explain(result):
+    trimmed = {key: value for key, value in result.items()
+               if key not in ("serverInfo", "serverParameters", "command", "$clusterTime", "operationTime", "ok")}
+    return json.loads(json_util.dumps(trimmed))
+
+
+# Records every command slower than SLOW_QUERY_MS, grouped by shape, along with the
+# routes/socket events that issued it (current_operation travels into Motor's worker
+# threads with the rest of the context). The first time a shape turns up slow, an
+# explain of that exact command is run in the background and kept with it.
+class SlowQueryListener(monitoring.CommandListener):
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, max_shapes=SLOW_QUERY_MAX_SHAPES, explain=SLOW_QUERY_EXPLAIN):
+        self.threshold_ms = threshold_ms
+        self.max_shapes = max_shapes
+        self.explain = explain
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._shapes = {}
+        self._loop = None
+
+    def attach_loop(self, loop):
+        self._loop = loop
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+        self._inflight[(event.connection_id, event.request_id)] = (
+            event.command, event.database_name, current_operation.get()
+        )
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+    def _finished(self, event):
+        started = self._inflight.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        duration_ms = event.duration_micros / 1000
+        if duration_ms < self.threshold_ms:
+            return
+
+        command, database_name, operation = started
+        shape = command_shape(event.command_name, command)
+        key = _shape_key(shape)
+        operation = operation or "background"
+        increment("slow_queries_total", {"command": event.command_name})
+
+        with self._lock:
+            entry = self._shapes.get(key)
+            first = entry is None
+            if first:
+                if len(self._shapes) >= self.max_shapes:
+                    return
+                entry = self._shapes[key] = {
+                    "shape": shape,
+                    "count": 0,
+                    "totalMs": 0.0,
+                    "maxMs": 0.0,
+                    "operations": {},
+                    "firstSeen": datetime.utcnow(),
+                    "explain": None,
+                }
+            entry["count"] += 1
+            entry["totalMs"] += duration_ms
+            entry["maxMs"] = max(entry["maxMs"], duration_ms)
+            entry["operations"][operation] = entry["operations"].get(operation, 0) + 1
+            entry["lastSeen"] = datetime.utcnow()
+
+        print(f"Slow {event.command_name} on {shape['collection']} ({duration_ms:.0f}ms) from {operation}")
+        if first and self.explain and event.command_name in EXPLAINABLE and self._loop:
+            explain_command = {k: v for k, v in command.items() if k not in SESSION_FIELDS}
+            # Submitted through background_tasks so the task is referenced until it
+            # finishes and is drained on shutdown.
+            self._loop.call_soon_threadsafe(
+                lambda: background_tasks.submit("explain", self._explain(key, database_name, explain_command))
+            )
+
+    async def _explain(self, key, database_name, command):
+        from app.server.database import get_client
+
+        try:
+            result = await get_client()[database_name].command({"explain": command, "verbosity": "queryPlanner"})
+            explain = _trim_explain(result)
+        except Exception as e:
+            explain = {"error": str(e)}
+        with self._lock:
+            if key in self._shapes:
+                self._shapes[key]["explain"] = explain
+
+    def report(self, limit=50):
+        with self._lock:
+            entries = [dict(entry, operations=dict(entry["operations"])) for entry in self._shapes.values()]
+        entries.sort(key=lambda entry: entry["totalMs"], reverse=True)
+        for entry in entries:
+            entry["avgMs"] = entry["totalMs"] / entry["count"]
+        return entries[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._shapes.clear()
+
+
+slow_query_listener = SlowQueryListener()
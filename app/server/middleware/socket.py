@@ -1,5 +1,109 @@
+import base64
+from urllib.parse import parse_qs
+
+from bson import ObjectId
 from fastapi_socketio import SocketManager
 from fastapi import FastAPI
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 app = FastAPI()
-socket_manager = SocketManager(app=app, mount_location="/socket.io", cors_allowed_origins=[])
\ No newline at end of file
+socket_manager = SocketManager(app=app, mount_location="/socket.io", cors_allowed_origins=[])
+
+# Clients that connect with codec=msgpack (in the auth payload or the query string)
+# get hot-path events as a single binary MessagePack argument instead of JSON: ids
+# are 12 raw bytes and base64 key material/ciphertext is sent as raw bytes. They are
+# kept in "<room>#bin" rooms so each emit encodes once per codec, not per recipient.
+# Everyone else, and every server without msgpack installed, stays on JSON.
+JSON = "json"
+MSGPACK = "msgpack"
+BINARY_SUFFIX = "#bin"
+
+ID_FIELDS = {"_id", "chatroom", "chatroomId", "sender", "members", "roomId"}
+BYTES_FIELDS = {"content", "DHKey", "ephKey"}
+
+
+def negotiate_codec(environ, auth=None):
+    requested = (auth or {}).get("codec") if isinstance(auth, dict) else None
+    if not requested:
+        requested = parse_qs(environ.get("QUERY_STRING", "")).get("codec", [JSON])[0]
+    return MSGPACK if requested == MSGPACK and msgpack else JSON
+
+
+def _pack_value(key, value):
+    if isinstance(value, dict):
+        return {k: _pack_value(k, v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_pack_value(key, item) for item in value]
+    if isinstance(value, str):
+        if key in ID_FIELDS and ObjectId.is_valid(value):
+            return ObjectId(value).binary
+        if key in BYTES_FIELDS:
+            # Only canonical base64 is sent as bytes so it decodes back to the same string.
+            try:
+                raw = base64.b64decode(value, validate=True)
+            except ValueError:
+                return value
+            if base64.b64encode(raw).decode() == value:
+                return raw
+    return value
+
+
+def _unpack_value(key, value):
+    if isinstance(value, dict):
+        return {k: _unpack_value(k, v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_unpack_value(key, item) for item in value]
+    if isinstance(value, bytes):
+        if key in ID_FIELDS and len(value) == 12:
+            return str(ObjectId(value))
+        if key in BYTES_FIELDS:
+            return base64.b64encode(value).decode()
+    return value
+
+
+def encode_event(payload):
+    return msgpack.packb(_pack_value(None, payload), use_bin_type=True)
+
+
+def decode_event(data):
+    if msgpack is None:
+        raise ValueError("Binary event payloads are not supported by this server")
+    return _unpack_value(None, msgpack.unpackb(data, raw=False))
+
+
+def codec_room(room, codec):
+    return f"{room}{BINARY_SUFFIX}" if codec == MSGPACK else str(room)
+
+
+async def enter_codec_room(sid, room, codec):
+    await socket_manager.enter_room(sid, codec_room(room, codec))
+
+
+async def leave_codec_rooms(sid, room):
+    await socket_manager.leave_room(sid, str(room))
+    await socket_manager.leave_room(sid, f"{room}{BINARY_SUFFIX}")
+
+
+def _has_members(room):
+    return room in socket_manager._sio.manager.rooms.get("/", {})
+
+
+# Emits to both the JSON and binary members of a room, encoding only for the codecs
+# that have someone listening. Events outside the hot path can pass binary=False to
+# send the same JSON payload to both.
+async def emit_event(event, payload, room, binary=True):
+    json_room, binary_room = str(room), f"{room}{BINARY_SUFFIX}"
+    if _has_members(json_room):
+        await socket_manager.emit(event, payload, room=json_room)
+    if _has_members(binary_room):
+        binary_payload = encode_event(payload) if binary and msgpack else payload
+        await socket_manager.emit(event, binary_payload, room=binary_room)
+
+
+def room_size(room):
+    rooms = socket_manager._sio.manager.rooms.get("/", {})
+    return sum(len(rooms[name]) for name in (str(room), f"{room}{BINARY_SUFFIX}") if name in rooms)
@@ -0,0 +1,360 @@
+import asyncio
+import mmap
+import os
+import struct
+import time
+import zlib
+from itertools import count
+from os import getenv
+
+import bson
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, ExecutionTimeout, WriteConcernError
+
+from app.server.middleware.message_store import insert_messages, existing_message_ids
+from app.server.middleware.metrics import increment, register_gauge
+
+
+# Empty disables the spool: message writes go straight to Mongo as before.
+MESSAGE_SPOOL_DIR = getenv("MESSAGE_SPOOL_DIR", "")
+MESSAGE_SPOOL_SEGMENT_BYTES = int(getenv("MESSAGE_SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+MESSAGE_SPOOL_FSYNC_MS = int(getenv("MESSAGE_SPOOL_FSYNC_MS", "10"))
+MESSAGE_SPOOL_REPLAY_MS = int(getenv("MESSAGE_SPOOL_REPLAY_MS", "1000"))
+MESSAGE_WRITE_TIMEOUT_MS = int(getenv("MESSAGE_WRITE_TIMEOUT_MS", "500"))
+BREAKER_FAILURE_THRESHOLD = int(getenv("BREAKER_FAILURE_THRESHOLD", "3"))
+BREAKER_RESET_SECONDS = float(getenv("BREAKER_RESET_SECONDS", "5"))
+
+# Errors that mean Mongo is unavailable or slow, as opposed to a bad write.
+UNAVAILABLE_ERRORS = (ConnectionFailure, ExecutionTimeout, WriteConcernError, asyncio.TimeoutError)
+
+# Each record is <length><crc32> followed by a BSON {"documents": [...]} payload.
+# A zero length marks the end of the written part of a preallocated segment.
+RECORD_HEADER = struct.Struct("<II")
+DUPLICATE_KEY = 11000
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+# Trips after BREAKER_FAILURE_THRESHOLD consecutive failures, then lets a single
+# probe through every BREAKER_RESET_SECONDS until one succeeds.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_seconds=BREAKER_RESET_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = HALF_OPEN
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != CLOSED:
+            print("Message store circuit closed, writing to Mongo again")
+        self.state = CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                print(f"Message store circuit opened after {self.failures} failures, spooling messages to disk")
+                increment("message_breaker_opened_total")
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+
+class Segment:
+    def __init__(self, path, size):
+        self.path = path
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.offset = 0
+
+    def fits(self, size):
+        return self.offset + size + RECORD_HEADER.size <= len(self.map)
+
+    def write(self, record):
+        self.map[self.offset:self.offset + len(record)] = record
+        self.offset += len(record)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+
+
+def encode_record(documents):
+    payload = bson.encode({"documents": documents})
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def is_duplicate_only(error):
+    if isinstance(error, DuplicateKeyError):
+        return True
+    if isinstance(error, BulkWriteError):
+        details = error.details or {}
+        write_errors = details.get("writeErrors", [])
+        return bool(write_errors) and not details.get("writeConcernErrors") and all(
+            write_error.get("code") == DUPLICATE_KEY for write_error in write_errors
+        )
+    return False
+
+
+# Inserts whichever of the documents Mongo doesn't have yet. A write that timed out on
+# our side may still have landed, so a duplicate key only means those messages are
+# already replayed; the check is repeated as long as each attempt makes progress.
+async def insert_missing(documents):
+    inserted = 0
+    previous = None
+    while True:
+        existing = await existing_message_ids([document["_id"] for document in documents])
+        missing = [document for document in documents if document["_id"] not in existing]
+        if not missing:
+            return inserted
+        if previous is not None and len(missing) >= previous:
+            raise RuntimeError(f"{len(missing)} spooled messages keep failing with duplicate keys")
+        previous = len(missing)
+        try:
+            await insert_messages(missing)
+            return inserted + len(missing)
+        except (DuplicateKeyError, BulkWriteError) as e:
+            if not is_duplicate_only(e):
+                raise
+            inserted += (e.details or {}).get("nInserted", 0) if isinstance(e, BulkWriteError) else 0
+
+
+def read_segment(path):
+    batches = []
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return batches
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset + RECORD_HEADER.size <= len(data):
+                length, checksum = RECORD_HEADER.unpack_from(data, offset)
+                if length == 0:
+                    break
+                payload = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+                if len(payload) < length or zlib.crc32(payload) != checksum:
+                    print(f"Stopping at torn record in {path} at offset {offset}")
+                    break
+                batches.append(bson.decode(payload)["documents"])
+                offset += RECORD_HEADER.size + length
+    return batches
+
+
+# Accepts message documents while Mongo is unavailable. Writes are appended to
+# memory-mapped segment files and acknowledged once a batched msync covers them; a
+# replayer inserts spooled messages that aren't in Mongo yet and deletes each segment
+# once it is fully replayed. Message ids are assigned before spooling, so replay is
+# idempotent and history stays in send order.
+#
+# Prefork workers each lock their own slot-N directory; a restarted worker takes over
+# the free slot and replays whatever its predecessor left behind.
+class MessageSpool:
+    def __init__(
+        self,
+        directory=MESSAGE_SPOOL_DIR,
+        segment_bytes=MESSAGE_SPOOL_SEGMENT_BYTES,
+        fsync_ms=MESSAGE_SPOOL_FSYNC_MS,
+        replay_ms=MESSAGE_SPOOL_REPLAY_MS,
+        write_timeout_ms=MESSAGE_WRITE_TIMEOUT_MS,
+    ):
+        self.directory = directory
+        self.enabled = bool(directory)
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_ms / 1000
+        self.replay_interval = replay_ms / 1000
+        self.write_timeout = write_timeout_ms / 1000
+        self.breaker = CircuitBreaker()
+        self._slot_dir = None
+        self._slot_lock = None
+        self._sequence = 0
+        self._active = None
+        self._unsynced = []
+        self._segment_lock = asyncio.Lock()
+        self._dirty = asyncio.Event()
+        self._tasks = []
+
+    def _claim_slot(self):
+        import fcntl
+
+        os.makedirs(self.directory, exist_ok=True)
+        for slot in count():
+            slot_dir = os.path.join(self.directory, f"slot-{slot}")
+            os.makedirs(slot_dir, exist_ok=True)
+            lock = open(os.path.join(slot_dir, "lock"), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+            return slot_dir, lock
+
+    def segments(self):
+        if not self._slot_dir:
+            return []
+        return sorted(
+            os.path.join(self._slot_dir, name)
+            for name in os.listdir(self._slot_dir) if name.endswith(".seg")
+        )
+
+    def _resolve(self, waiters, error=None):
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if error:
+                waiter.set_exception(error)
+            else:
+                waiter.set_result(None)
+
+    def _seal(self):
+        if self._active is None:
+            return
+        waiters, self._unsynced = self._unsynced, []
+        try:
+            self._active.close()
+        except OSError as e:
+            self._resolve(waiters, e)
+            raise
+        finally:
+            self._active = None
+        self._resolve(waiters)
+
+    async def _rotate(self, size):
+        async with self._segment_lock:
+            if self._active is not None and self._active.fits(size):
+                return
+            self._seal()
+            self._sequence += 1
+            path = os.path.join(self._slot_dir, f"{self._sequence:012d}.seg")
+            self._active = Segment(path, max(self.segment_bytes, size + RECORD_HEADER.size))
+
+    async def append(self, documents):
+        record = encode_record(documents)
+        if self._active is None or not self._active.fits(len(record)):
+            await self._rotate(len(record))
+        self._active.write(record)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._unsynced.append(waiter)
+        self._dirty.set()
+        await waiter
+        increment("messages_spooled_total", amount=len(documents))
+
+    async def _fsync_loop(self):
+        while True:
+            await self._dirty.wait()
+            # Gives concurrent senders a moment to land in the same msync.
+            await asyncio.sleep(self.fsync_interval)
+            self._dirty.clear()
+            async with self._segment_lock:
+                waiters, self._unsynced = self._unsynced, []
+                if self._active is None:
+                    self._resolve(waiters)
+                    continue
+                try:
+                    await asyncio.to_thread(self._active.map.flush)
+                except OSError as e:
+                    print(f"Failed to sync message spool: {e}")
+                    self._resolve(waiters, e)
+                    continue
+            self._resolve(waiters)
+
+    async def store(self, documents):
+        if not self.enabled:
+            return await insert_messages(documents)
+
+        if self.breaker.allow():
+            try:
+                await asyncio.wait_for(insert_messages(documents), self.write_timeout)
+                self.breaker.record_success()
+                return
+            except UNAVAILABLE_ERRORS as e:
+                self.breaker.record_failure()
+                print(f"Message write failed, spooling {len(documents)} messages: {e!r}")
+            except Exception:
+                # Not an outage, so the caller gets the error, but a trial write that
+                # fails must still reopen the breaker rather than leave it half-open.
+                self.breaker.record_failure()
+                raise
+        await self.append(documents)
+
+    async def replay(self):
+        if not self.segments() or not self.breaker.allow():
+            return
+
+        # Segments opened after this point belong to the next round.
+        async with self._segment_lock:
+            self._seal()
+            sealed = self.segments()
+
+        replayed = 0
+        for path in sealed:
+            try:
+                batches = await asyncio.to_thread(read_segment, path)
+                for documents in batches:
+                    replayed += await insert_missing(documents)
+            except Exception as e:
+                self.breaker.record_failure()
+                print(f"Spool replay interrupted, {replayed} messages replayed so far: {e!r}")
+                increment("messages_replayed_total", amount=replayed)
+                if isinstance(e, UNAVAILABLE_ERRORS):
+                    return
+                raise
+            os.remove(path)
+
+        self.breaker.record_success()
+        increment("messages_replayed_total", amount=replayed)
+        print(f"Replayed {replayed} spooled messages")
+
+    async def _replay_loop(self):
+        while True:
+            await asyncio.sleep(self.replay_interval)
+            try:
+                await self.replay()
+            except Exception as e:
+                print(f"Spool replay failed: {e!r}")
+
+    async def start(self):
+        if not self.enabled or self._tasks:
+            return
+        self._slot_dir, self._slot_lock = self._claim_slot()
+        leftover = self.segments()
+        if leftover:
+            self._sequence = int(os.path.basename(leftover[-1]).split(".")[0])
+            print(f"Found {len(leftover)} spooled segments in {self._slot_dir}, replaying")
+        self._tasks = [
+            asyncio.create_task(self._fsync_loop()),
+            asyncio.create_task(self._replay_loop()),
+        ]
+
+    async def stop(self):
+        if not self._tasks:
+            return
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Whatever is still spooled stays on disk for the next start.
+        self._seal()
+        self._slot_lock.close()
+
+
+message_spool = MessageSpool()
+register_gauge("message_spool_segments", lambda: len(message_spool.segments()))
+register_gauge("message_breaker_open", lambda: int(message_spool.breaker.state != CLOSED))
+
+
+async def store_messages(documents):
+    await message_spool.store(documents)
@@ -0,0 +1,74 @@
+import asyncio
+from os import getenv
+
+from app.server.middleware.deadlines import without_deadline
+from app.server.middleware.metrics import increment, register_gauge
+from app.server.middleware.profiling import set_operation
+
+
+TASK_MAX_CONCURRENCY = int(getenv("TASK_MAX_CONCURRENCY", "64"))
+TASK_MAX_PENDING = int(getenv("TASK_MAX_PENDING", "10000"))
+TASK_DRAIN_SECONDS = float(getenv("TASK_DRAIN_SECONDS", "10"))
+
+
+# Runs work that the caller doesn't need to wait for (notification fan-out) after the
+# response has gone out. At most max_concurrency tasks run at once, failures are logged
+# and counted instead of surfacing as "Task exception was never retrieved", and
+# drain() waits for whatever is still queued on shutdown.
+class TaskRunner:
+    def __init__(self, max_concurrency=TASK_MAX_CONCURRENCY, max_pending=TASK_MAX_PENDING, drain_timeout=TASK_DRAIN_SECONDS):
+        self.max_concurrency = max_concurrency
+        self.max_pending = max_pending
+        self.drain_timeout = drain_timeout
+        self._semaphore = None
+        self._tasks = set()
+        self._closing = False
+
+    @property
+    def pending(self):
+        return len(self._tasks)
+
+    def submit(self, name, coro):
+        if self._closing or len(self._tasks) >= self.max_pending:
+            coro.close()
+            increment("background_tasks_dropped_total", {"task": name})
+            print(f"Dropped background task {name}: {'shutting down' if self._closing else 'queue is full'}")
+            return None
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        task = asyncio.create_task(self._run(name, coro))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, name, coro):
+        set_operation(f"task {name}")
+        try:
+            async with self._semaphore:
+                with without_deadline():
+                    await coro
+            increment("background_tasks_completed_total", {"task": name})
+        except asyncio.CancelledError:
+            # Closes the coroutine if it was cancelled while still waiting for a slot.
+            coro.close()
+            raise
+        except Exception as e:
+            increment("background_tasks_failed_total", {"task": name})
+            print(f"Background task {name} failed: {e!r}")
+
+    async def drain(self):
+        self._closing = True
+        if not self._tasks:
+            return
+        print(f"Draining {len(self._tasks)} background tasks")
+        _, unfinished = await asyncio.wait(set(self._tasks), timeout=self.drain_timeout)
+        for task in unfinished:
+            task.cancel()
+        if unfinished:
+            await asyncio.gather(*unfinished, return_exceptions=True)
+            print(f"Cancelled {len(unfinished)} background tasks still running after {self.drain_timeout}s")
+
+
+background_tasks = TaskRunner()
+register_gauge("background_tasks_pending", lambda: background_tasks.pending)
@@ -1,11 +1,28 @@
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from bson import ObjectId
+from hashlib import sha256
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 from app.server.database import get_db
+from app.server.middleware.durability import durable, CRITICAL, STANDARD
 
 
 db = get_db()
 
+# Pops the user's first one-time prekey and returns it, or None if they have none left.
+# The pop and the read are one atomic update, like the conditional $pop in bundle
+# claims, so a key can never be handed to two senders.
+async def claim_otp_key(user_id):
+    user = await durable("Users", CRITICAL).find_one_and_update(
+        {"_id": ObjectId(user_id), "otpKeys.0": {"$exists": True}},
+        {"$pop": {"otpKeys": -1}, "$inc": {"version": 1}},
+        projection={"otpKeys": {"$slice": 1}},
+        return_document=ReturnDocument.BEFORE
+    )
+    return user["otpKeys"][0] if user else None
+
+
 async def generate_chatroom_name(member_ids, current_user_id):
     other_members_ids = [ObjectId(member) for member in member_ids if str(member) != str(current_user_id)]
     other_members = await db["Users"].find(
@@ -16,3 +33,38 @@ async def generate_chatroom_name(member_ids, current_user_id):
 
     return chatroom_name if chatroom_name else "Unnamed Chatroom"
 
+
+async def generate_chatroom_names(member_ids):
+    members = await db["Users"].find(
+        {"_id": {"$in": [ObjectId(member) for member in member_ids]}},
+        {"username": 1}
+    ).to_list(None)
+    usernames = {str(user["_id"]): user.get("username", "Unknown") for user in members}
+
+    chatroom_names = {}
+    for member in member_ids:
+        other_names = [
+            usernames[str(other)] for other in member_ids
+            if str(other) != str(member) and str(other) in usernames
+        ]
+        chatroom_names[str(member)] = ", ".join(other_names) if other_names else "Unnamed Chatroom"
+
+    return chatroom_names
+
+
+def chatroom_member_key(member_ids):
+    canonical = ",".join(sorted({str(member) for member in member_ids}))
+    return sha256(canonical.encode("utf-8")).hexdigest()
+
+
+async def backfill_chatroom_member_keys():
+    async for chatroom in db["Chatrooms"].find(
+        {"memberKey": {"$exists": False}, "largeRoom": {"$ne": True}}, {"members": 1}
+    ):
+        try:
+            await durable("Chatrooms", STANDARD).update_one(
+                {"_id": chatroom["_id"]},
+                {"$set": {"memberKey": chatroom_member_key(chatroom.get("members", []))}}
+            )
+        except DuplicateKeyError:
+            print(f"Chatroom {chatroom['_id']} duplicates an existing member set, leaving it unkeyed")
@@ -0,0 +1,39 @@
+from functools import wraps
+from pydantic import ValidationError
+
+from app.server.middleware.socket import socket_manager, decode_event
+
+
+def event_errors(error: ValidationError):
+    return [
+        {"field": ".".join(str(part) for part in detail["loc"]), "message": detail["msg"]}
+        for detail in error.errors(include_url=False)
+    ]
+
+
+def error_message(errors):
+    first = errors[0]
+    return f"{first['field']}: {first['message']}" if first["field"] else first["message"]
+
+
+def validate_event(model):
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(sid, data=None):
+            try:
+                if isinstance(data, (bytes, bytearray)):
+                    data = decode_event(data)
+            except ValueError:
+                await socket_manager.emit("error", {"message": "Invalid binary payload"}, room=sid)
+                return {"error": "Invalid binary payload"}
+            try:
+                event = model.model_validate(data)
+            except ValidationError as e:
+                errors = event_errors(e)
+                await socket_manager.emit(
+                    "error", {"message": error_message(errors), "errors": errors}, room=sid
+                )
+                return {"error": error_message(errors), "errors": errors}
+            return await handler(sid, event)
+        return wrapper
+    return decorator
@@ -0,0 +1,72 @@
+from pydantic import BaseModel, Field, field_validator, AfterValidator
+from pydantic_core import PydanticCustomError
+from bson import ObjectId
+from os import getenv
+from typing import Optional, List, Any, Annotated
+
+# Payload schemas for Socket.IO events. Pydantic builds each validator once at import,
+# so validating an event is a single pass through compiled code.
+
+def validate_object_id(value: str) -> str:
+    if not ObjectId.is_valid(value):
+        raise PydanticCustomError("object_id", "Invalid ObjectId: {value}", {"value": value})
+    return value
+
+
+ObjectIdStr = Annotated[str, AfterValidator(validate_object_id)]
+
+# A batch is validated, looked up and inserted as one event, so its size is capped
+# to keep one event from doing an unbounded amount of work.
+MESSAGE_BATCH_MAX = int(getenv("MESSAGE_BATCH_MAX", "100"))
+
+
+class EventMessageDetails(BaseModel):
+    content: str
+    ephKey: Optional[str] = None
+    otpID: Optional[int] = None
+    DHKey: str = Field(min_length=1)
+    timestamp: str = Field(min_length=1)
+
+    @field_validator("content")
+    @classmethod
+    def content_not_blank(cls, value: str) -> str:
+        if not value.strip():
+            raise PydanticCustomError("empty_content", "Message content cannot be empty")
+        return value
+
+
+class RoomEvent(BaseModel):
+    chatroomId: ObjectIdStr
+
+
+class ChatroomMessageEvent(BaseModel):
+    chatroomId: ObjectIdStr
+    message: EventMessageDetails
+
+    # Serializes the message once; the stored document and the broadcast payload
+    # share the same message body and differ only in how ids are represented.
+    def to_documents(self, user_id: str):
+        message_id = ObjectId()
+        details = self.message.model_dump()
+        document = {
+            "_id": message_id,
+            "chatroom": ObjectId(self.chatroomId),
+            "sender": ObjectId(user_id),
+            "message": details,
+            "readBy": []
+        }
+        payload = {
+            "_id": str(message_id),
+            "chatroom": self.chatroomId,
+            "sender": user_id,
+            "message": details
+        }
+        return document, payload
+
+
+class ChatroomMessageBatchEvent(BaseModel):
+    messages: List[Any] = Field(min_length=1, max_length=MESSAGE_BATCH_MAX)
+
+
+class ReauthenticateEvent(BaseModel):
+    token: str = Field(min_length=1)
@@ -57,11 +57,12 @@ class User(BaseModel):
 class UserResponse(User):
     password: Optional[str] = Field(default=None, exclude=True)
     id: Optional[PyObjectId] = Field(alias="_id")
-    identityKey: str
-    schnorrKey: str
-    schnorrSig: str
-    username: str
-    otpKeys: Optional[List[Dict[int, str]]]
+    identityKey: Optional[str] = None
+    schnorrKey: Optional[str] = None
+    schnorrSig: Optional[str] = None
+    username: Optional[str] = None
+    otpKeys: Optional[List[Dict[int, str]]] = None
+    otpKeyCount: Optional[int] = None
 
     class Config:
         json_encoders = {ObjectId: str}
@@ -72,10 +73,7 @@ class UserResponse(User):
                 "identityKey": "identity key",
                 "schnorrKey": "Schnor Key",
                 "schnorrSig": "Schnor Sig",
-                "otpKeys": [
-                    {1: "DH Public Key 1"},
-                    {2: "DH Public Key 2"}
-                ]
+                "otpKeyCount": 2
             }
         }
 
@@ -90,6 +88,9 @@ class UserLogin(BaseModel):
     username: str
     password: str
 
+class RefreshTokenRequest(BaseModel):
+    refreshToken: str
+
 class ChangePasswordRequest(BaseModel):
     currentPassword: str
     newPassword: str
@@ -0,0 +1,103 @@
+from fastapi import APIRouter, Depends, HTTPException, Response, status
+from fastapi.responses import PlainTextResponse
+
+from app.server.middleware.admin import require_admin
+from app.server.middleware.memory import GROUP_BY, memory_profiler, memory_report
+from app.server.middleware.metrics import render_metrics
+from app.server.middleware.slow_queries import slow_query_listener
+
+router = APIRouter(dependencies=[Depends(require_admin)])
+
+#@route GET api/admin/metrics
+#@description Process metrics in the Prometheus text format
+#@access Admin
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return render_metrics()
+
+#@route GET api/admin/slow-queries
+#@description Slow query shapes ranked by total time, with the routes that ran them and an explain plan
+#@access Admin
+@router.get("/slow-queries", response_model=dict)
+async def get_slow_queries(limit: int = 50):
+    return {
+        "thresholdMs": slow_query_listener.threshold_ms,
+        "queries": slow_query_listener.report(limit)
+    }
+
+#@route DELETE api/admin/slow-queries
+#@description Clears the slow query log
+#@access Admin
+@router.delete("/slow-queries", response_model=str)
+async def reset_slow_queries(response: Response):
+    slow_query_listener.reset()
+    response.status_code = status.HTTP_200_OK
+    return "Slow query log cleared."
+
+#@route GET api/admin/memory
+#@description Resident memory, tracemalloc status and the socket manager's live sockets, sessions and rooms
+#@access Admin
+@router.get("/memory", response_model=dict)
+async def get_memory():
+    return memory_report()
+
+#@route POST api/admin/memory/baseline
+#@description Starts tracemalloc if needed and takes the snapshot later diffs compare against, on this worker only
+#@access Admin
+@router.post("/memory/baseline", response_model=dict)
+async def set_memory_baseline(response: Response):
+    await memory_profiler.set_baseline()
+    response.status_code = status.HTTP_201_CREATED
+    return memory_profiler.status()
+
+#@route GET api/admin/memory/top
+#@description Top allocation sites in a fresh snapshot of this worker, groupBy is lineno, filename or traceback
+#@access Admin
+@router.get("/memory/top", response_model=dict)
+async def get_memory_top(limit: int = 20, groupBy: str = "lineno"):
+    check_group_by(groupBy)
+    top = await memory_profiler.top(clamp_sites(limit), groupBy)
+    if top is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Memory tracing is off on this worker, take a baseline first."
+        )
+    return {"groupBy": groupBy, "sites": top}
+
+#@route GET api/admin/memory/diff
+#@description Allocation sites that grew the most since this worker's baseline
+#@access Admin
+@router.get("/memory/diff", response_model=dict)
+async def get_memory_diff(limit: int = 20, groupBy: str = "lineno"):
+    check_group_by(groupBy)
+    diff = await memory_profiler.diff(clamp_sites(limit), groupBy)
+    if diff is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="No memory baseline on this worker, take one first."
+        )
+    return {"groupBy": groupBy, "baselineAt": memory_profiler.status()["baselineAt"], "sites": diff}
+
+#@route DELETE api/admin/memory/tracing
+#@description Stops tracemalloc and drops the baseline on this worker
+#@access Admin
+@router.delete("/memory/tracing", response_model=str)
+async def stop_memory_tracing(response: Response):
+    memory_profiler.stop()
+    response.status_code = status.HTTP_200_OK
+    return "Memory tracing stopped."
+
+
+MAX_MEMORY_SITES = 100
+
+
+def clamp_sites(limit):
+    return max(1, min(limit, MAX_MEMORY_SITES))
+
+
+def check_group_by(group_by):
+    if group_by not in GROUP_BY:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"groupBy must be one of {', '.join(GROUP_BY)}."
+        )
@@ -1,12 +1,23 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Response
+from fastapi import APIRouter, Depends, HTTPException, status, Response, Request
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
 
 from app.server.database import get_db
+from app.server.middleware.durability import durable, CRITICAL
 from app.server.models.chatroom import Chatroom, SentChatroom
 from app.server.middleware.auth import authenticate_user
-from app.server.middleware.socket import socket_manager
-from app.server.middleware.utils import generate_chatroom_name
+from app.server.middleware.socket import emit_event
+from app.server.middleware.utils import generate_chatroom_name, generate_chatroom_names, chatroom_member_key, claim_otp_key
+from app.server.middleware.inbox import get_inbox, sync_inbox_members, remove_inbox_chatroom
+from app.server.middleware.membership import (
+    LARGE_ROOM_THRESHOLD, MEMBER_PAGE_SIZE, add_member, create_large_chatroom, is_large, is_member,
+    large_room_name, list_members, member_ids
+)
+from app.server.middleware.jobs import enqueue_job
+from app.server.middleware.etag import make_etag, etag_matches, not_modified, set_cache_headers
+from app.server.middleware.tasks import background_tasks
 
 db = get_db()
 router = APIRouter()
@@ -34,18 +45,21 @@ async def get_user_chatrooms(
             detail="Invalid token payload."
         )
 
-    chatrooms = await db["Chatrooms"].find({
-        "members": ObjectId(user_id),
-        "firstMessage": True
-    }).to_list(None)
+    inbox = await get_inbox(user_id)
 
     formatted_chatrooms = []
-    for chatroom in chatrooms:
-        formatted_chatrooms.append({
-            "_id": str(chatroom["_id"]),
-            "name": await generate_chatroom_name(chatroom["members"], user_id),
-            "members": [str(member) for member in chatroom["members"]]
-        })
+    for row in inbox:
+        formatted_chatroom = {
+            "_id": str(row["chatroom"]),
+            "name": row["name"],
+            "members": row["members"],
+            "lastMessageId": str(row["lastMessageId"]) if row.get("lastMessageId") else None,
+            "lastMessageAt": row.get("lastMessageAt"),
+            "unreadCount": row.get("unreadCount", 0)
+        }
+        if "memberCount" in row:
+            formatted_chatroom["memberCount"] = row["memberCount"]
+        formatted_chatrooms.append(formatted_chatroom)
 
     response.status_code = status.HTTP_200_OK
     return formatted_chatrooms
@@ -57,6 +71,7 @@ async def get_user_chatrooms(
 @router.get("/{chatroom_id}", response_model=dict)
 async def get_user_chatroom(
     chatroom_id: str, 
+    request: Request,
     response: Response, 
     payload: dict = Depends(authenticate_user)
 ):
@@ -68,17 +83,33 @@ async def get_user_chatroom(
             detail="Invalid token payload."
         )
 
-    chatroom = await db["Chatrooms"].find_one(
-        {"_id": ObjectId(chatroom_id), "members": ObjectId(user_id)}
-    )
+    query = {"_id": ObjectId(chatroom_id)}
 
-    if not chatroom:
+    if request.headers.get("If-None-Match"):
+        current = await db["Chatrooms"].find_one(query, {"version": 1, "members": 1, "largeRoom": 1})
+        if current and await is_member(current, user_id):
+            etag = make_etag(chatroom_id, current.get("version", 0), user_id)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
+    chatroom = await db["Chatrooms"].find_one(query)
+
+    if not chatroom or not await is_member(chatroom, user_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Chatroom not found or user is not a member."
         )
 
+    # The name is worked out per user, so the ETag is too.
+    set_cache_headers(response, make_etag(chatroom_id, chatroom.get("version", 0), user_id))
     response.status_code = status.HTTP_200_OK
+    if is_large(chatroom):
+        return {
+            "_id": str(chatroom["_id"]),
+            "name": await large_room_name(chatroom),
+            "largeRoom": True,
+            "memberCount": chatroom["memberCount"]
+        }
     return {
         "_id": str(chatroom["_id"]),
         "name": await generate_chatroom_name(chatroom["members"], user_id),
@@ -103,43 +134,56 @@ async def create_chatroom(
             detail="Invalid token payload."
         )
 
-    chatroom_dict = chatroom.dict(by_alias=True)
-    chatroom_dict["members"] = sorted(
-        [ObjectId(user_id)] + [ObjectId(m) for m in chatroom_dict.get("members", [])]
+    members = sorted(
+        {ObjectId(user_id)} | {ObjectId(m) for m in chatroom.members}
     )
+    new_id = ObjectId()
 
-    existing_chatroom = await db["Chatrooms"].find_one({"members": chatroom_dict["members"]})
-
-    if existing_chatroom:
-        response.status_code = status.HTTP_200_OK
+    # Large rooms aren't deduplicated by member set, every create makes a new one.
+    if len(members) > LARGE_ROOM_THRESHOLD:
+        saved_chatroom = await create_large_chatroom(new_id, members)
+        response.status_code = status.HTTP_201_CREATED
         return {
-            "_id": str(existing_chatroom["_id"]),
-            "name": await generate_chatroom_name(existing_chatroom["members"], user_id),
-            "members": [str(member) for member in existing_chatroom["members"]]
+            "_id": str(new_id),
+            "name": await large_room_name(saved_chatroom),
+            "largeRoom": True,
+            "memberCount": saved_chatroom["memberCount"],
+            "firstMessage": False
         }
-    
-    chatroom_dict["firstMessage"] = False
 
-    result = await db["Chatrooms"].insert_one(chatroom_dict)
-    chatroom_dict["_id"] = str(result.inserted_id)
+    member_key = chatroom_member_key(members)
+
+    try:
+        saved_chatroom = await durable("Chatrooms", CRITICAL).find_one_and_update(
+            {"memberKey": member_key},
+            {"$setOnInsert": {
+                "_id": new_id,
+                "members": members,
+                "firstMessage": False,
+                "version": 1
+            }},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        saved_chatroom = await db["Chatrooms"].find_one({"memberKey": member_key})
 
-    chatroom_dict["name"] = await generate_chatroom_name(chatroom_dict["members"], user_id)
-    chatroom_dict["members"] = [str(member) for member in chatroom_dict["members"]]
+    chatroom_dict = {
+        "_id": str(saved_chatroom["_id"]),
+        "name": await generate_chatroom_name(saved_chatroom["members"], user_id),
+        "members": [str(member) for member in saved_chatroom["members"]]
+    }
 
-    for member in chatroom_dict["members"]:
-        member_chatroom_name = await generate_chatroom_name(chatroom_dict["members"], member)
-        chatroom_data = {
-            "_id": chatroom_dict["_id"],
-            "name": member_chatroom_name,
-            "members": chatroom_dict["members"]
-        }
+    if saved_chatroom["_id"] != new_id:
+        response.status_code = status.HTTP_200_OK
+        return chatroom_dict
+
+    chatroom_dict["firstMessage"] = False
 
     response.status_code = status.HTTP_201_CREATED
     return chatroom_dict
 
 
-
-
 #@route POST api/chatroom/{chatroom_id}/join
 #@description Add the authenticated user to the chatroom members list
 #@access Protected
@@ -164,28 +208,184 @@ async def join_chatroom(
             detail="Chatroom not found!"
         )
 
-    if ObjectId(user_id) in chatroom.get("members", []):
+    if await is_member(chatroom, user_id):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="User already a member of the chatroom!"
         )
 
-    update_result = await db["Chatrooms"].update_one(
-        {"_id": ObjectId(chatroom_id)},
-        {"$addToSet": {"members": ObjectId(user_id)}}
-    )
+    try:
+        added = await add_member(chatroom, user_id)
+    except DuplicateKeyError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="A chatroom with these members already exists!"
+        )
 
-    if update_result.modified_count == 0:
+    if not added:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Failed to add user to chatroom!"
         )
 
+    if chatroom.get("firstMessage", False):
+        await sync_inbox_members(chatroom, [ObjectId(user_id)])
+
     response.status_code = status.HTTP_200_OK
     return f"User {user_id} successfully added to chatroom {chatroom_id}!"
 
+#@route POST api/chatroom/{chatroom_id}/bundles
+#@description Returns every other member's key bundle and claims one OTP key from each
+#@access Protected
+@router.post("/{chatroom_id}/bundles", response_model=dict)
+async def claim_member_bundles(
+    chatroom_id: str,
+    response: Response,
+    payload: dict = Depends(authenticate_user)
+):
+    user_id = payload.get("user_id")
+
+    if not user_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token payload."
+        )
+
+    chatroom = await db["Chatrooms"].find_one({"_id": ObjectId(chatroom_id)}, {"members": 1, "largeRoom": 1})
+    if not chatroom:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Chatroom not found!"
+        )
+
+    if not await is_member(chatroom, user_id):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not a member of this chatroom."
+        )
+
+    others = [member for member in await member_ids(chatroom) if str(member) != user_id]
+    users = await db["Users"].find(
+        {"_id": {"$in": others}},
+        {"username": 1, "identityKey": 1, "schnorrKey": 1, "schnorrSig": 1, "otpKeys": {"$slice": 1}}
+    ).to_list(None)
+    users = {user["_id"]: user for user in users}
+
+    # Each claim only pops the key that was read, so a concurrent claim on the same
+    # member makes ours a no-op instead of handing the same key to two senders.
+    claim_id = ObjectId()
+    claims = {}
+    for member, user in users.items():
+        if user.get("otpKeys"):
+            claims[member] = UpdateOne(
+                {"_id": member, "otpKeys.0": user["otpKeys"][0]},
+                {"$pop": {"otpKeys": -1}, "$set": {"otpClaim": claim_id}, "$inc": {"version": 1}}
+            )
+
+    claimed = set()
+    if claims:
+        result = await durable("Users", CRITICAL).bulk_write(list(claims.values()), ordered=False)
+        if result.modified_count == len(claims):
+            claimed = set(claims)
+        else:
+            # Someone else claimed from at least one member at the same time. Only keys
+            # still tagged with this claim are certainly ours; the rest count as lost.
+            confirmed = await db["Users"].find(
+                {"_id": {"$in": list(claims)}, "otpClaim": claim_id}, {"_id": 1}
+            ).to_list(None)
+            claimed = {user["_id"] for user in confirmed}
+
+    members = []
+    for member in others:
+        user = users.get(member)
+        if not user:
+            members.append({"_id": str(member), "status": "notFound"})
+            continue
+
+        bundle = {
+            "_id": str(member),
+            "username": user["username"],
+            "identityKey": user["identityKey"],
+            "schnorrKey": user["schnorrKey"],
+            "schnorrSig": user["schnorrSig"],
+        }
+        if member in claimed:
+            bundle["status"] = "claimed"
+            bundle["otpKey"] = user["otpKeys"][0]
+        elif member in claims:
+            bundle["status"] = "conflict"
+        else:
+            bundle["status"] = "exhausted"
+        members.append(bundle)
+
+    response.headers["Cache-Control"] = "no-store"
+    response.status_code = status.HTTP_200_OK
+    return {"members": members}
+
+
+#@route GET api/chatroom/{chatroom_id}/members
+#@description Lists the chatroom's members a page at a time, pass the returned next as after for the following page
+#@access Protected
+@router.get("/{chatroom_id}/members", response_model=dict)
+async def get_chatroom_members(
+    chatroom_id: str,
+    response: Response,
+    after: str = None,
+    limit: int = MEMBER_PAGE_SIZE,
+    payload: dict = Depends(authenticate_user)
+):
+    user_id = payload.get("user_id")
+
+    if not user_id:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid token payload."
+        )
+
+    if after and not ObjectId.is_valid(after):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid pagination cursor."
+        )
+    limit = max(1, min(limit, MEMBER_PAGE_SIZE))
+
+    chatroom = await db["Chatrooms"].find_one(
+        {"_id": ObjectId(chatroom_id)}, {"members": 1, "largeRoom": 1, "memberCount": 1}
+    )
+    if not chatroom or not await is_member(chatroom, user_id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Chatroom not found or user is not a member."
+        )
+
+    page, next_cursor = await list_members(chatroom, after, limit)
+    users = await db["Users"].find({"_id": {"$in": page}}, {"username": 1}).to_list(None)
+    usernames = {user["_id"]: user.get("username", "Unknown") for user in users}
+
+    response.status_code = status.HTTP_200_OK
+    return {
+        "members": [
+            {"_id": str(member), "username": usernames.get(member, "Unknown")} for member in page
+        ],
+        "next": next_cursor,
+        "memberCount": chatroom.get("memberCount", len(chatroom.get("members", [])))
+    }
+
+
+# Runs on background_tasks once the delete has been accepted.
+async def notify_chatroom_deleted(chatroom_id, members, name=None):
+    names = {str(member): name for member in members} if name else await generate_chatroom_names(members)
+    for member in members:
+        await emit_event(
+            "chatroomDeleted",
+            {"chatroomID": f"{chatroom_id}", "chatroomName": f"{names[str(member)]}"},
+            room=str(member),
+            binary=False
+        )
+
+
 #@route DELETE api/chatroom/{chatroom_id}
-#@description Delete a chatroom and it's messages
+#@description Delete a chatroom, its messages are removed by a background job
 #@access Protected
 @router.delete("/{chatroom_id}", response_model=str)
 async def delete_chatroom(
@@ -209,37 +409,32 @@ async def delete_chatroom(
         )
     
     deleted_id = chatroom["_id"]
-    members = list(chatroom["members"])
     isFirstMessage = chatroom["firstMessage"]
 
-    if ObjectId(user_id) not in chatroom["members"]:
+    if not await is_member(chatroom, user_id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not authorized to delete this chatroom."
         )
 
-    await db["Messages"].delete_many({"chatroom": ObjectId(chatroom_id)})
+    members = await member_ids(chatroom)
+    name = await large_room_name(chatroom) if is_large(chatroom) else None
 
-    delete_result = await db["Chatrooms"].delete_one({"_id": ObjectId(chatroom_id)})
+    delete_result = await durable("Chatrooms", CRITICAL).delete_one({"_id": ObjectId(chatroom_id)})
 
     if delete_result.deleted_count == 0:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Failed to delete chatroom."
         )
+
+    await remove_inbox_chatroom(chatroom_id)
+    await enqueue_job("deleteChatroom", {"chatroom": chatroom_id})
     
     if isFirstMessage:
-        for member in members:
-            chatroomName = await generate_chatroom_name(members,member)
-            await socket_manager.emit(
-                "chatroomDeleted",
-                {"chatroomID": f"{deleted_id}", "chatroomName": f"{chatroomName}"},
-                room=str(member) 
-            )
+        background_tasks.submit("chatroomDeleted", notify_chatroom_deleted(deleted_id, members, name))
 
-
-
-    response.status_code = status.HTTP_200_OK
+    response.status_code = status.HTTP_202_ACCEPTED
     return f"Chatroom {chatroom_id} successfully deleted."
 
 #@route GET api/chatroom/{otherUserID}/{isSend}
@@ -249,6 +444,7 @@ async def delete_chatroom(
 async def get_user_crypto_info(
     otherUserID: str,
     isSend: str,
+    request: Request,
     response: Response,
     payload: dict = Depends(authenticate_user)
 ):
@@ -260,7 +456,23 @@ async def get_user_crypto_info(
             detail="Invalid token payload.",
         )
 
-    targetUser = await db["Users"].find_one({"_id": ObjectId(otherUserID)})
+    if isSend == "send":
+        targetUser = await db["Users"].find_one(
+            {"_id": ObjectId(otherUserID)},
+            {"username": 1, "identityKey": 1, "schnorrKey": 1, "schnorrSig": 1}
+        )
+    else:
+        if request.headers.get("If-None-Match"):
+            current = await db["Users"].find_one({"_id": ObjectId(otherUserID)}, {"keyVersion": 1})
+            if current:
+                etag = make_etag(otherUserID, current.get("keyVersion", 0))
+                if etag_matches(request, etag):
+                    return not_modified(etag)
+
+        targetUser = await db["Users"].find_one(
+            {"_id": ObjectId(otherUserID)},
+            {"username": 1, "identityKey": 1, "schnorrKey": 1, "schnorrSig": 1, "keyVersion": 1}
+        )
 
     if not targetUser:
         raise HTTPException(
@@ -277,21 +489,17 @@ async def get_user_crypto_info(
     }
 
     if isSend == "send":
-        otpKeys = targetUser.get("otpKeys", [])
-        if not otpKeys:
+        poppedKey = await claim_otp_key(otherUserID)
+        if poppedKey is None:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="No OTP keys available for this user."
             )
 
-        poppedKey = otpKeys.pop(0)
-
-        await db["Users"].update_one(
-            {"_id": ObjectId(otherUserID)},
-            {"$set": {"otpKeys": otpKeys}}
-        )
-
         user_data["otpKey"] = poppedKey
+        response.headers["Cache-Control"] = "no-store"
+    else:
+        set_cache_headers(response, make_etag(otherUserID, targetUser.get("keyVersion", 0)))
 
     response.status_code = status.HTTP_200_OK
     return user_data
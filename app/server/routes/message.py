@@ -3,9 +3,11 @@ from bson import ObjectId
 from app.server.database import get_db
 from app.server.models.message import Message, SentMessage, MessageDetails, ReadMessagesRequest
 from app.server.middleware.auth import authenticate_user
+from app.server.middleware.receipts import read_receipts
+from app.server.middleware.message_store import find_unread, unread_lookup_stage
+from app.server.middleware.spool import store_messages
+from app.server.middleware.membership import is_member, member_filter
 from typing import List
-import asyncio
-from pymongo.errors import OperationFailure
 
 db = get_db()
 router = APIRouter()
@@ -18,6 +20,44 @@ async def test():
     return "Messages route working."
 
 
+# @route GET api/message/unread
+# @description Get unread messages grouped by chatroom for every chatroom the user is in
+# @access Protected
+@router.get("/unread", response_model=list[dict])
+async def get_unread_messages(
+    response: Response,
+    limit: int = 100,
+    payload: dict = Depends(authenticate_user)
+):
+    user_id = payload["user_id"]
+    limit = max(1, min(limit, 100))
+
+    rooms = await db["Chatrooms"].aggregate([
+        {"$match": await member_filter(user_id)},
+        unread_lookup_stage(user_id, limit),
+        {"$project": {
+            "messages": {"$first": "$unread.messages"},
+            "unreadCount": {"$ifNull": [{"$first": {"$first": "$unread.count.total"}}, 0]}
+        }},
+        {"$match": {"unreadCount": {"$gt": 0}}}
+    ]).to_list(None)
+
+    unread = []
+    for room in rooms:
+        for message in room["messages"]:
+            message["_id"] = str(message["_id"])
+            message["chatroom"] = str(message["chatroom"])
+            message["sender"] = str(message["sender"])
+        unread.append({
+            "chatroom": str(room["_id"]),
+            "unreadCount": room["unreadCount"],
+            "messages": room["messages"]
+        })
+
+    response.status_code = status.HTTP_200_OK
+    return unread
+
+
 # @route GET api/message/chatroom_id
 # @description Get messages from chatroom
 # @access Protected
@@ -36,16 +76,13 @@ async def get_messages(
             detail="Chatroom not found!"
         )
 
-    if str(user_id) not in map(str, chatroom.get("members", [])):
+    if not await is_member(chatroom, user_id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not authorized to access this chatroom."
         )
     
-    unread_messages = await db["Messages"].find({
-        "chatroom": ObjectId(chatroom_id),
-        "readBy": {"$ne": user_id}
-    }).to_list(100)
+    unread_messages = await find_unread(ObjectId(chatroom_id), user_id, 100)
 
     if not unread_messages:
         return []
@@ -79,13 +116,14 @@ async def send_message(
             detail="Chatroom not found!"
         )
 
-    if ObjectId(user_id) not in chatroom.get("members", []):
+    if not await is_member(chatroom, user_id):
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You are not authorized to send messages in this chatroom."
         )
 
     message_dict = {
+        "_id": ObjectId(),
         "chatroom": ObjectId(chatroom_id),
         "sender": ObjectId(user_id),
         "message": {
@@ -99,8 +137,8 @@ async def send_message(
     }
 
 
-    result = await db["Messages"].insert_one(message_dict)
-    message_dict["_id"] = str(result.inserted_id)
+    await store_messages([message_dict])
+    message_dict["_id"] = str(message_dict["_id"])
 
     response.status_code = status.HTTP_200_OK
     return Message(
@@ -117,7 +155,7 @@ async def send_message(
     )
 
 #@route PUT api/message/read/
-#@description Mark message as read
+#@description Mark messages as read, the receipts are written in batches shortly after
 #@access Protected
 @router.put("/read", response_model=dict)
 async def mark_messages_as_read_and_delete(
@@ -132,68 +170,7 @@ async def mark_messages_as_read_and_delete(
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid message ID format.")
 
-    async def transaction():
-        async with await db.client.start_session() as session:
-            async with session.start_transaction():
-                try:
-                    messages = await db["Messages"].find(
-                        {"_id": {"$in": object_ids}, "readBy": {"$ne": str(user_id)}},
-                        session=session
-                    ).to_list(len(object_ids))
-
-                    if not messages:
-                        raise HTTPException(
-                            status_code=status.HTTP_404_NOT_FOUND,
-                            detail="No unread messages found!"
-                        )
-
-                    await db["Messages"].update_many(
-                        {"_id": {"$in": object_ids}},
-                        {"$addToSet": {"readBy": str(user_id)}},
-                        session=session
-                    )
-
-                    messages_to_delete = []
-
-                    for message in messages:
-                        chatroom = await db["Chatrooms"].find_one(
-                            {"_id": message["chatroom"]}, session=session
-                        )
-                        if not chatroom:
-                            continue
-
-                        chatroom_members = set(map(str, chatroom["members"]))
-                        read_by_users = set(map(str, message.get("readBy", []))) | {str(user_id)}
-
-                        if chatroom_members == read_by_users:
-                            messages_to_delete.append(message["_id"])
-
-                    if messages_to_delete:
-                        await db["Messages"].delete_many(
-                            {"_id": {"$in": messages_to_delete}}, session=session
-                        )
-
-                    await session.commit_transaction()
-                    return {"message": "Messages marked as read."}
-
-                except OperationFailure as e:
-                    await session.abort_transaction()
-                    raise e
-                
-    async def retry_transaction(fn, max_retries=5, delay=0.5):
-        for attempt in range(max_retries):
-            try:
-                return await fn()
-            except OperationFailure as e:
-                if "TransientTransactionError" in e.details.get("errorLabels", []):
-                    if attempt < max_retries - 1:
-                        print(f"Retrying transaction... Attempt {attempt + 1}/{max_retries}")
-                        await asyncio.sleep(delay * (attempt + 1))
-                    else:
-                        print("Transaction failed after retries.")
-                        raise
-                else:
-                    raise
+    read_receipts.add(user_id, object_ids)
 
-    response.status_code = status.HTTP_200_OK
-    return await retry_transaction(transaction)
\ No newline at end of file
+    response.status_code = status.HTTP_202_ACCEPTED
+    return {"message": "Messages marked as read."}
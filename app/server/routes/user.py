@@ -1,22 +1,55 @@
-from fastapi import APIRouter, Body, Response, status, HTTPException, Depends
+import asyncio
+from fastapi import APIRouter, Body, Response, Request, status, HTTPException, Depends
 from fastapi.encoders import jsonable_encoder
 from bson import ObjectId
-from os import getenv
-from jose import jwt
-from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from typing import Optional
 
 
 from app.server.database import get_db
-from app.server.models.user import User, UserResponse, UserLogin, UserRegister, ChangePasswordRequest
-from app.server.middleware.auth import authenticate_user
-from app.server.middleware.hash import hash_password, verify_password
+from app.server.middleware.durability import durable, CRITICAL, STANDARD
+from app.server.models.user import User, UserResponse, UserLogin, UserRegister, ChangePasswordRequest, RefreshTokenRequest
+from app.server.middleware.auth import authenticate_user, create_access_token
+from app.server.middleware.refresh_tokens import issue_refresh_token, rotate_refresh_token, revoke_refresh_token, revoke_user_tokens
+from app.server.middleware.hash import hash_password, verify_password, needs_rehash
+from app.server.middleware.jobs import enqueue_job
+from app.server.middleware.inbox import sync_inbox_members
+from app.server.middleware.membership import member_filter
+from app.server.middleware.etag import make_etag, etag_matches, not_modified, set_cache_headers
+from app.server.middleware.tasks import background_tasks
+from app.server.middleware.utils import claim_otp_key
 
 db = get_db()
 
 router = APIRouter()
 
-SECRET_KEY = getenv("JWT_SECRET")
-ALGORITHM = getenv("JWT_ALGO")
+KEY_FIELDS = {"username", "identityKey", "schnorrKey", "schnorrSig"}
+USER_FIELDS = {"username", "identityKey", "schnorrKey", "schnorrSig", "otpKeys", "otpKeyCount"}
+DEFAULT_USER_FIELDS = "username,identityKey,schnorrKey,schnorrSig,otpKeyCount"
+
+# Maps the fields= query parameter to a Mongo projection. otpKeys is only sent when
+# asked for, otherwise clients get otpKeyCount, computed by the server.
+def user_projection(fields: Optional[str]) -> dict:
+    requested = {field.strip() for field in (fields or DEFAULT_USER_FIELDS).split(",") if field.strip()}
+    unknown = requested - USER_FIELDS
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(sorted(unknown))}."
+        )
+
+    projection = {field: 1 for field in requested if field != "otpKeyCount"}
+    if "otpKeyCount" in requested:
+        projection["otpKeyCount"] = {"$size": {"$ifNull": ["$otpKeys", []]}}
+    return projection
+
+def normalize_otp_keys(user: dict) -> dict:
+    if "otpKeys" in user and isinstance(user["otpKeys"], list):
+        user["otpKeys"] = [
+            {int(k): str(v)} for key in user["otpKeys"] for k, v in key.items()
+            if isinstance(k, int) and isinstance(v, str)
+        ]
+    return user
 
 #@route GET api/user/test
 #@description Test user route
@@ -54,7 +87,7 @@ async def create_user(new_user: UserRegister, response: Response):
             detail="User already exists!"
         )
     
-    hash = hash_password(password)
+    hash = await asyncio.to_thread(hash_password, password)
 
     user_dict = {
         "username": username,
@@ -63,15 +96,26 @@ async def create_user(new_user: UserRegister, response: Response):
         "identityKey": new_user.identityKey,
         "schnorrKey": new_user.schnorrKey,
         "schnorrSig": new_user.schnorrSig,
-        "otpKeys": new_user.otpKeys if "otpKeys" in new_user else []
+        "otpKeys": new_user.otpKeys if "otpKeys" in new_user else [],
+        "version": 1,
+        "keyVersion": 1
     }
 
-    result = await db["Users"].insert_one(user_dict)
+    result = await durable("Users", CRITICAL).insert_one(user_dict)
     user_dict["_id"] = str(result.inserted_id)
 
     response.status_code = status.HTTP_200_OK
     return user_dict
 
+# Moves a user's hash to the current bcrypt cost after a successful login. Matching on
+# the old hash keeps a concurrent password change from being overwritten.
+async def rehash_password(user_id, password, old_hash):
+    rehashed = await asyncio.to_thread(hash_password, password)
+    await durable("Users", STANDARD).update_one(
+        {"_id": user_id, "password": old_hash},
+        {"$set": {"password": rehashed["hashed_password"], "salt": rehashed["salt"]}}
+    )
+
 # @route POST /api/user/login
 # @description Logs user in and returns JWT
 # @access Public
@@ -86,44 +130,67 @@ async def login(user_login: UserLogin, response: Response):
             detail="Email or Password is incorrect."
         )
     
-    if not verify_password(user_login.password, user["salt"], user["password"]):
+    if not await asyncio.to_thread(verify_password, user_login.password, user["salt"], user["password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Email or Password is incorrect."
         )
-    
-    expiration = datetime.utcnow() + timedelta(minutes=15)
-    payload = {
-        "user_id": str(user["_id"]),
-        "exp": expiration,
-        "iat": datetime.utcnow(),
-    }
 
-    token = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+    if needs_rehash(user["password"]):
+        background_tasks.submit("rehashPassword", rehash_password(user["_id"], user_login.password, user["password"]))
+    
+    token, _ = create_access_token(user["_id"])
+    refresh_token = await issue_refresh_token(user["_id"])
     
     response.status_code = status.HTTP_200_OK
     return {
         "message": f"User has been logged in successfully.",
         "token": token,
+        "refreshToken": refresh_token,
         "otpKeys": len(user["otpKeys"])
     }
 
+# @route POST /api/user/refresh
+# @description Exchanges a refresh token for a new access token and refresh token
+# @access Public
+@router.post("/refresh")
+async def refresh(request: RefreshTokenRequest, response: Response):
+    rotated = await rotate_refresh_token(request.refreshToken)
+    if not rotated:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid or expired refresh token."
+        )
+
+    user_id, refresh_token = rotated
+    token, _ = create_access_token(user_id)
+
+    response.status_code = status.HTTP_200_OK
+    return {"token": token, "refreshToken": refresh_token}
+
+# @route POST /api/user/logout
+# @description Revokes a refresh token and every token rotated from the same login
+# @access Public
+@router.post("/logout", response_model=str)
+async def logout(request: RefreshTokenRequest, response: Response):
+    await revoke_refresh_token(request.refreshToken)
+
+    response.status_code = status.HTTP_200_OK
+    return "Logged out."
+
 # @route GET api/user
 # @description Get all users
 # @access Protected
-@router.get("/", response_model=list[UserResponse])
+@router.get("/", response_model=list[UserResponse], response_model_exclude_none=True)
 async def get_all_users(
     response: Response,
+    fields: Optional[str] = None,
     payload: dict = Depends(authenticate_user)
 ):
-    users = await db["Users"].find().to_list()
+    users = await db["Users"].find({}, user_projection(fields)).to_list()
 
     for user in users:
-        if "otpKeys" in user and isinstance(user["otpKeys"], list):
-            user["otpKeys"] = [
-                {int(k): str(v)} for key in user["otpKeys"] for k, v in key.items()
-                if isinstance(k, int) and isinstance(v, str) 
-            ]
+        normalize_otp_keys(user)
 
     response.status_code = status.HTTP_200_OK
     return users
@@ -131,39 +198,49 @@ async def get_all_users(
 # @route GET api/user/{user_id}
 # @description Get User by ID
 # @access Protected
-@router.get("/{user_id}", response_model=UserResponse)
+@router.get("/{user_id}", response_model=UserResponse, response_model_exclude_none=True)
 async def get_user(
     user_id: str, 
+    request: Request,
     response: Response, 
+    fields: Optional[str] = None,
     payload: dict = Depends(authenticate_user)
 ):
-    user = await db["Users"].find_one({"_id": ObjectId(user_id)})
+    projection = user_projection(fields)
+    fields_key = ",".join(sorted(projection))
+
+    if request.headers.get("If-None-Match"):
+        current = await db["Users"].find_one({"_id": ObjectId(user_id)}, {"version": 1})
+        if current:
+            etag = make_etag(user_id, current.get("version", 0), fields_key)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+
+    user = await db["Users"].find_one({"_id": ObjectId(user_id)}, {**projection, "version": 1})
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found!"
         )
     
-    if "otpKeys" in user and isinstance(user["otpKeys"], list):
-            user["otpKeys"] = [
-                {int(k): str(v)} for key in user["otpKeys"] for k, v in key.items()
-                if isinstance(k, int) and isinstance(v, str) 
-            ]
+    normalize_otp_keys(user)
     
+    set_cache_headers(response, make_etag(user_id, user.get("version", 0), fields_key))
     response.status_code = status.HTTP_200_OK
     return user
 
 #@route GET api/user/name/{userName}
 #@description Get Users by Username
 #@access Protected
-@router.get("/name/{userName}", response_model=list[UserResponse])
-async def getUserByName(userName: str, response: Response, payload:dict = Depends(authenticate_user)):
+@router.get("/name/{userName}", response_model=list[UserResponse], response_model_exclude_none=True)
+async def getUserByName(userName: str, response: Response, fields: Optional[str] = None, payload:dict = Depends(authenticate_user)):
     user_id = payload["user_id"]
     users = await db["Users"].find(
         {
             "username": {"$regex": f"^{userName}", "$options": "i"},
             "_id": {"$ne": ObjectId(user_id)}  # Exclude the current user
-        }
+        },
+        user_projection(fields)
     ).to_list(10)
     if not users:
         raise HTTPException(
@@ -171,11 +248,7 @@ async def getUserByName(userName: str, response: Response, payload:dict = Depend
             detail="Username not found!"
         )
     for user in users:
-        if "otpKeys" in user and isinstance(user["otpKeys"], list):
-            user["otpKeys"] = [
-                {int(k): str(v)} for key in user["otpKeys"] for k, v in key.items()
-                if isinstance(k, int) and isinstance(v, str) 
-            ]
+        normalize_otp_keys(user)
     response.status_code = status.HTTP_200_OK
     return users
 
@@ -184,10 +257,11 @@ async def getUserByName(userName: str, response: Response, payload:dict = Depend
 # @route PUT api/user
 # @description Update the authenticated user's information
 # @access Protected
-@router.put("/", response_model=UserResponse)
+@router.put("/", response_model=UserResponse, response_model_exclude_none=True)
 async def update_user(
     user: dict, 
     response: Response, 
+    fields: Optional[str] = None,
     payload: dict = Depends(authenticate_user)
 ):
     user_id = payload.get("user_id")
@@ -197,34 +271,39 @@ async def update_user(
             detail="Invalid token payload."
         )
     
-    update_result = await db["Users"].update_one(
-        {"_id": ObjectId(user_id)}, {"$set": jsonable_encoder(user)}
+    user_update = jsonable_encoder(user)
+    user_update.pop("version", None)
+    user_update.pop("keyVersion", None)
+    version_update = {"version": 1}
+    if KEY_FIELDS & user_update.keys():
+        version_update["keyVersion"] = 1
+
+    updated_user = await durable("Users", CRITICAL).find_one_and_update(
+        {"_id": ObjectId(user_id)},
+        {"$set": user_update, "$inc": version_update},
+        projection=user_projection(fields),
+        return_document=ReturnDocument.AFTER
     )
-    if update_result.matched_count == 0:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found!"
-        )
-    
-    updated_user = await db["Users"].find_one({"_id": ObjectId(user_id)})
     if not updated_user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found after update!"
+            detail="User not found!"
         )
     
-    if "otpKeys" in updated_user and isinstance(updated_user["otpKeys"], list):
-            updated_user["otpKeys"] = [
-                {int(k): str(v)} for key in updated_user["otpKeys"] for k, v in key.items()
-                if isinstance(k, int) and isinstance(v, str) 
-            ]
+    if "username" in user_update:
+        memberships = await member_filter(user_id)
+        await durable("Chatrooms", STANDARD).update_many(memberships, {"$inc": {"version": 1}})
+        async for chatroom in db["Chatrooms"].find({**memberships, "firstMessage": True}):
+            await sync_inbox_members(chatroom)
+
+    normalize_otp_keys(updated_user)
     
     response.status_code = status.HTTP_200_OK
     return updated_user
 
 
 # @route DELETE api/user/{user_id}
-# @description Delete a user by ID
+# @description Delete a user by ID, their memberships and messages are removed by a background job
 # @access Protected
 @router.delete("/{user_id}", response_model=str)
 async def delete_user(
@@ -238,14 +317,17 @@ async def delete_user(
             detail="You are not authorized to delete this user."
         )
     
-    delete_result = await db["Users"].delete_one({"_id": ObjectId(user_id)})
+    delete_result = await durable("Users", CRITICAL).delete_one({"_id": ObjectId(user_id)})
     if delete_result.deleted_count == 0:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="User not found!"
         )
+
+    await revoke_user_tokens(user_id)
+    await enqueue_job("deleteUser", {"user": user_id})
     
-    response.status_code = status.HTTP_200_OK
+    response.status_code = status.HTTP_202_ACCEPTED
     return "User deleted."
 
 # @route PUT api/user/otpKeys
@@ -273,9 +355,9 @@ async def update_otp_keys(otpKeys: list[dict], response: Response, payload: dict
             detail="Invalid format for OTP keys. Expected an array of objects.",
         )
 
-    await db["Users"].update_one(
+    await durable("Users", CRITICAL).update_one(
         {"_id": ObjectId(user_id)},
-        {"$push": {"otpKeys": {"$each": otpKeys}}}
+        {"$push": {"otpKeys": {"$each": otpKeys}}, "$inc": {"version": 1}}
     )
 
     response.status_code = status.HTTP_200_OK
@@ -290,7 +372,7 @@ async def pop_otp_key(
     response: Response,
     payload: dict = Depends(authenticate_user)
 ):
-    target_user = await db["Users"].find_one({"_id": ObjectId(user_id)})
+    target_user = await db["Users"].find_one({"_id": ObjectId(user_id)}, {"_id": 1})
     if not target_user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -304,20 +386,13 @@ async def pop_otp_key(
             detail="Authenticated user not found!"
         )
 
-    otpKeys = target_user.get("otpKeys", [])
-    if not otpKeys:
+    popped_key = await claim_otp_key(user_id)
+    if popped_key is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="No OTP keys available for this user."
         )
 
-    popped_key = otpKeys.pop(0)
-
-    await db["Users"].update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"otpKeys": otpKeys}}
-    )
-
     response.status_code = status.HTTP_200_OK
     return {"popped_key": popped_key}
 
@@ -355,21 +430,22 @@ async def change_password(
             detail="User not found!"
         )
 
-    if not verify_password(current_password, user["salt"], user["password"]):
+    if not await asyncio.to_thread(verify_password, current_password, user["salt"], user["password"]):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Current password is incorrect."
         )
     
-    new_hashed_password = hash_password(new_password)
+    new_hashed_password = await asyncio.to_thread(hash_password, new_password)
 
-    await db["Users"].update_one(
+    await durable("Users", CRITICAL).update_one(
         {"_id": ObjectId(user_id)},
         {"$set": {
             "password": new_hashed_password["hashed_password"],
             "salt": new_hashed_password["salt"]
         }}
     )
+    await revoke_user_tokens(user_id)
 
     response.status_code = status.HTTP_200_OK
     return "Password changed."
@@ -0,0 +1,163 @@
+import argparse
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import simple_websocket
+
+# Opens and closes waves of Socket.IO connections against a running server and samples
+# GET /api/admin/memory after each wave. A healthy worker returns to the same socket
+# counts after every wave and its memory levels off; anything that only ever goes up
+# is flagged. Run against a single worker so every wave lands on the same process.
+#
+#   python -m benchmarks.soak_memory --token <jwt> --admin-token <ADMIN_TOKEN> \
+#       --chatroom <chatroom_id> --clients 200 --rounds 30
+#
+# With --tracemalloc a baseline is taken before the first wave and the allocation
+# sites that grew the most are printed at the end.
+
+SOCKET_COUNTS = ("engineioSockets", "connected", "sessions", "environs", "rooms", "roomMemberships", "pendingCallbacks")
+
+
+def admin_request(args, method, path):
+    request = urllib.request.Request(
+        f"{args.url}/api/admin{path}", method=method, headers={"X-Admin-Token": args.admin_token}
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+
+def ws_url(url):
+    return url.replace("http", "ws", 1) + "/socket.io/?EIO=4&transport=websocket"
+
+
+def receive_packet(ws, prefix):
+    while True:
+        packet = ws.receive(timeout=10)
+        if packet is None:
+            raise RuntimeError(f"Timed out waiting for {prefix!r}")
+        if packet == "2":
+            ws.send("3")
+        elif packet.startswith(prefix):
+            return packet
+
+
+# One client's lifetime in raw Engine.IO/Socket.IO packets: handshake, namespace
+# connect, optionally join and leave a chatroom, then drop the connection.
+def run_client(args):
+    ws = simple_websocket.Client.connect(ws_url(args.url), headers={"Authorization": f"Bearer {args.token}"})
+    try:
+        receive_packet(ws, "0")
+        ws.send("40" + json.dumps({"codec": args.codec}))
+        receive_packet(ws, "40")
+        if args.chatroom:
+            room = json.dumps({"chatroomId": args.chatroom})
+            ws.send(f'42["joinRoom",{room}]')
+            time.sleep(args.hold)
+            ws.send(f'42["leaveRoom",{room}]')
+        else:
+            time.sleep(args.hold)
+    finally:
+        ws.close()
+
+
+def run_wave(args, pool):
+    failures = 0
+    for future in [pool.submit(run_client, args) for _ in range(args.clients)]:
+        try:
+            future.result()
+        except Exception as e:
+            failures += 1
+            if failures == 1:
+                print(f"  client failed: {e!r}")
+    return failures
+
+
+def sample(args):
+    report = admin_request(args, "GET", "/memory")
+    values = {"rssBytes": report["rssBytes"] or 0, "tracedBytes": report["tracemalloc"]["tracedBytes"]}
+    values.update({name: report["sockets"][name] for name in SOCKET_COUNTS})
+    return values
+
+
+def slope(values):
+    n = len(values)
+    mean_x = (n - 1) / 2
+    mean_y = sum(values) / n
+    denominator = sum((x - mean_x) ** 2 for x in range(n))
+    return sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values)) / denominator if denominator else 0
+
+
+# Growth is only flagged when the tail of the run never goes down and the metric
+# ended meaningfully above where it started, so GC and allocator noise on a level
+# series doesn't trip it.
+def grows_monotonically(values, window, min_growth):
+    tail = values[-window:]
+    if len(tail) < 2:
+        return False
+    never_drops = all(later >= earlier for earlier, later in zip(tail, tail[1:]))
+    return never_drops and tail[-1] - tail[0] > min_growth and slope(values) > 0
+
+
+def print_sites(diff):
+    for site in diff["sites"]:
+        print(f"  {site['sizeDiff'] / 1024:+10.1f} KiB {site['countDiff']:+8d} blocks  {site['site'][0]}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--token", required=True, help="access token the clients connect with")
+    parser.add_argument("--admin-token", required=True)
+    parser.add_argument("--chatroom", help="chatroom each client joins and leaves")
+    parser.add_argument("--codec", default="json", choices=("json", "msgpack"))
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--hold", type=float, default=0.5, help="seconds each client stays connected")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to wait after a wave before sampling")
+    parser.add_argument("--window", type=int, default=10, help="trailing samples that must all grow to flag a leak")
+    parser.add_argument("--min-growth-kib", type=float, default=1024)
+    parser.add_argument("--tracemalloc", action="store_true")
+    args = parser.parse_args()
+
+    if args.tracemalloc:
+        admin_request(args, "POST", "/memory/baseline")
+
+    samples = [sample(args)]
+    print(f"start: rss {samples[0]['rssBytes'] / 2**20:.1f} MiB, {samples[0]['connected']} connected")
+
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        for round_number in range(1, args.rounds + 1):
+            failures = run_wave(args, pool)
+            time.sleep(args.settle)
+            samples.append(sample(args))
+            current = samples[-1]
+            print(
+                f"round {round_number}: rss {current['rssBytes'] / 2**20:.1f} MiB, "
+                f"traced {current['tracedBytes'] / 2**20:.1f} MiB, "
+                + ", ".join(f"{name} {current[name]}" for name in SOCKET_COUNTS)
+                + (f", {failures} failed" if failures else "")
+            )
+
+    leaks = []
+    for name in ("rssBytes", "tracedBytes"):
+        values = [entry[name] for entry in samples[1:]]
+        if any(values) and grows_monotonically(values, args.window, args.min_growth_kib * 1024):
+            leaks.append(f"{name} grew every round, {(values[-1] - values[0]) / 1024:.0f} KiB in total")
+    # Every client has disconnected by the time a sample is taken, so the socket
+    # counts should be back where they started.
+    for name in SOCKET_COUNTS:
+        if samples[-1][name] > samples[0][name]:
+            leaks.append(f"{name} went from {samples[0][name]} to {samples[-1][name]} with no clients connected")
+
+    if args.tracemalloc:
+        print("top growth since baseline:")
+        print_sites(admin_request(args, "GET", "/memory/diff?limit=15"))
+
+    if leaks:
+        print("possible leaks:")
+        for leak in leaks:
+            print(f"  {leak}")
+        raise SystemExit(1)
+    print("no monotonic growth detected")
@@ -0,0 +1,60 @@
+import argparse
+import base64
+import os
+import timeit
+from bson import ObjectId
+from socketio import packet
+
+from app.server.middleware.socket import encode_event, decode_event
+
+# Compares the Socket.IO packet for a newMessage event in JSON and in the msgpack
+# codec: bytes on the wire per message and time to encode (and decode) one packet.
+#
+#   python -m benchmarks.socket_codec --number 20000
+
+
+def b64(size):
+    return base64.b64encode(os.urandom(size)).decode()
+
+
+PAYLOAD = {
+    "_id": str(ObjectId()),
+    "chatroom": str(ObjectId()),
+    "sender": str(ObjectId()),
+    "message": {
+        "content": b64(256),
+        "DHKey": b64(32),
+        "ephKey": b64(32),
+        "otpID": 3,
+        "timestamp": "2024-12-02T12:00:00"
+    }
+}
+
+
+def json_packet(payload):
+    return packet.Packet(packet.EVENT, namespace="/", data=["newMessage", payload]).encode()
+
+
+def binary_packet(payload):
+    return packet.Packet(packet.EVENT, namespace="/", data=["newMessage", encode_event(payload)]).encode()
+
+
+def wire_size(encoded):
+    parts = encoded if isinstance(encoded, list) else [encoded]
+    return sum(len(part.encode() if isinstance(part, str) else part) for part in parts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    assert decode_event(encode_event(PAYLOAD)) == PAYLOAD
+
+    for name, fn in (("json", json_packet), ("msgpack", binary_packet)):
+        best = min(timeit.repeat(lambda: fn(PAYLOAD), number=args.number, repeat=5))
+        print(f"{name}: {wire_size(fn(PAYLOAD))} bytes, {best / args.number * 1e6:.2f}us to encode")
+
+    encoded = encode_event(PAYLOAD)
+    best = min(timeit.repeat(lambda: decode_event(encoded), number=args.number, repeat=5))
+    print(f"msgpack: {best / args.number * 1e6:.2f}us to decode an incoming payload")
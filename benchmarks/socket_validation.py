@@ -0,0 +1,74 @@
+import argparse
+import timeit
+from bson import ObjectId
+
+from app.server.models.events import ChatroomMessageEvent
+from app.server.models.message import Message, MessageDetails
+
+# Compares the per-event cost of the schema layer (one validation pass, one
+# serialization) against the hand-written checks and repeated dict() calls that
+# chatroomMessage used before.
+#
+#   python -m benchmarks.socket_validation --number 20000
+
+USER_ID = str(ObjectId())
+EVENT = {
+    "chatroomId": str(ObjectId()),
+    "message": {
+        "content": "U2FsdGVkX1+2m7z0n0yXcH0zN5kq9h3a4Q==",
+        "DHKey": "BL0x7V9eR2mS0qJ8oWcXk5p1y3u6t4r2e0w9q8",
+        "ephKey": "BPz1a7c9e2g4i6k8m0o2q4s6u8w0y2",
+        "otpID": 3,
+        "timestamp": "2024-12-02T12:00:00"
+    }
+}
+
+
+def handwritten(data):
+    chatroom_id = data.get("chatroomId")
+    message_details = data.get("message")
+    if not chatroom_id or not message_details:
+        return None
+    if not message_details.get("content") or message_details["content"].strip() == "":
+        return None
+    if not message_details.get("DHKey") or not message_details.get("timestamp"):
+        return None
+    message = Message(
+        chatroom=chatroom_id,
+        sender=USER_ID,
+        message=MessageDetails(
+            content=message_details["content"],
+            DHKey=message_details["DHKey"],
+            timestamp=message_details["timestamp"],
+            ephKey=message_details.get("ephKey"),
+            otpID=message_details.get("otpID"),
+        )
+    )
+    document = message.dict(by_alias=True)
+    saved_message = message.dict(by_alias=True)
+    return document, {
+        "_id": str(saved_message["_id"]),
+        "chatroom": chatroom_id,
+        "sender": USER_ID,
+        "message": {
+            "content": message_details["content"],
+            "DHKey": message_details["DHKey"],
+            "ephKey": message_details.get("ephKey"),
+            "otpID": message_details.get("otpID"),
+            "timestamp": message_details["timestamp"]
+        }
+    }
+
+
+def schema(data):
+    return ChatroomMessageEvent.model_validate(data).to_documents(USER_ID)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    for name, fn in (("hand-written checks", handwritten), ("event schema", schema)):
+        best = min(timeit.repeat(lambda: fn(EVENT), number=args.number, repeat=5))
+        print(f"{name}: {best / args.number * 1e6:.2f}us per event")
@@ -0,0 +1,75 @@
+import argparse
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+# Measures how long the app takes to import in a fresh interpreter and how long the
+# prefork launcher takes until it answers its first request.
+#
+#   python -m benchmarks.startup --runs 5 --workers 4
+
+IMPORT_SNIPPET = (
+    "import time; started = time.perf_counter(); "
+    "import app.server.app; "
+    "print(time.perf_counter() - started)"
+)
+
+
+def time_import(runs):
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, "-c", IMPORT_SNIPPET])
+        samples.append(float(output.decode().strip().splitlines()[-1]))
+    return samples
+
+
+def time_launch(runs, workers, port, extra_args, timeout):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        launcher = subprocess.Popen(
+            [sys.executable, "-m", "app.server.launcher", "--workers", str(workers), "--port", str(port), *extra_args],
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            while True:
+                try:
+                    urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1).read()
+                    break
+                except OSError:
+                    if launcher.poll() is not None:
+                        raise SystemExit(f"Launcher exited with code {launcher.returncode} before answering")
+                    if time.perf_counter() - started > timeout:
+                        raise SystemExit(f"Launcher did not answer on port {port} within {timeout:.0f}s")
+                    time.sleep(0.01)
+            samples.append(time.perf_counter() - started)
+        finally:
+            # SIGTERM lets the launcher stop its workers; kill it if it doesn't exit.
+            launcher.send_signal(signal.SIGTERM)
+            try:
+                launcher.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                launcher.kill()
+                launcher.wait()
+    return samples
+
+
+def report(name, samples):
+    print(f"{name}: median {statistics.median(samples) * 1000:.1f}ms, min {min(samples) * 1000:.1f}ms, max {max(samples) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the launcher's first response")
+    args = parser.parse_args()
+
+    report("import app.server.app", time_import(args.runs))
+    report(f"launcher, {args.workers} workers", time_launch(args.runs, args.workers, args.port, [], args.timeout))
+    report(f"launcher --preload, {args.workers} workers", time_launch(args.runs, args.workers, args.port, ["--preload"], args.timeout))
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import statistics
+import time
+from datetime import datetime
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from app.server.database import URI
+from app.server.middleware.durability import WRITE_CONCERNS
+
+# Measures message insert latency under each durability profile, using the write
+# concerns the app would use (so DURABILITY_* overrides apply here too). Inserts go
+# to a scratch collection that is dropped afterwards. Run it against the same
+# topology as production: on a standalone mongod, w=majority costs little more than
+# w=1, while on a replica set it waits for a secondary.
+#
+#   DB_URI=mongodb://... python -m benchmarks.write_concern --number 2000 --concurrency 8
+
+SCRATCH_COLLECTION = "DurabilityBenchmark"
+
+
+def message_document(chatroom_id, sender_id):
+    return {
+        "_id": ObjectId(),
+        "chatroom": chatroom_id,
+        "sender": sender_id,
+        "message": {
+            "content": "U2FsdGVkX1+2m7z0n0yXcH0zN5kq9h3a4Q==" * 8,
+            "DHKey": "BL0x7V9eR2mS0qJ8oWcXk5p1y3u6t4r2e0w9q8",
+            "ephKey": "BPz1a7c9e2g4i6k8m0o2q4s6u8w0y2",
+            "otpID": 3,
+            "timestamp": datetime.utcnow().isoformat()
+        },
+        "readBy": []
+    }
+
+
+async def measure(collection, number, concurrency, batch):
+    chatroom_id, sender_id = ObjectId(), ObjectId()
+    latencies = []
+    remaining = number
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= batch
+            documents = [message_document(chatroom_id, sender_id) for _ in range(batch)]
+            started = time.perf_counter()
+            if batch == 1:
+                await collection.insert_one(documents[0])
+            else:
+                await collection.insert_many(documents)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return latencies, len(latencies) * batch / elapsed
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def main(args):
+    client = AsyncIOMotorClient(URI)
+    database = client["Anonymouse"]
+    try:
+        for profile in args.profiles:
+            write_concern = WRITE_CONCERNS[profile]
+            collection = database[SCRATCH_COLLECTION].with_options(write_concern=write_concern)
+            await measure(collection, args.warmup, args.concurrency, args.batch)
+            latencies, throughput = await measure(collection, args.number, args.concurrency, args.batch)
+            print(
+                f"{profile:<9} {str(write_concern.document):<30} "
+                f"p50 {percentile(latencies, 0.5):6.2f}ms  p95 {percentile(latencies, 0.95):6.2f}ms  "
+                f"p99 {percentile(latencies, 0.99):6.2f}ms  mean {statistics.mean(latencies):6.2f}ms  "
+                f"{throughput:8.0f} msg/s"
+            )
+    finally:
+        await database[SCRATCH_COLLECTION].drop()
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=2000, help="messages inserted per profile")
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--batch", type=int, default=1, help="messages per insert, >1 uses insert_many")
+    parser.add_argument("--profiles", nargs="+", default=list(WRITE_CONCERNS), choices=list(WRITE_CONCERNS))
+    args = parser.parse_args()
+
+    if not URI:
+        raise SystemExit("Set DB_URI to the MongoDB deployment to benchmark.")
+    asyncio.run(main(args))
@@ -0,0 +1,34 @@
+import asyncio
+
+from app.server.middleware import admission
+from app.server.middleware.admission import AdmissionMiddleware
+
+
+def run_request(monkeypatch, path):
+    monkeypatch.setattr(admission, "_inflight", admission.ADMISSION_MAX_INFLIGHT)
+    called = []
+    sent = []
+
+    async def app(scope, receive, send):
+        called.append(scope["path"])
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": path}
+    asyncio.run(AdmissionMiddleware(app)(scope, None, send))
+    return called, sent
+
+
+def test_admin_routes_are_not_shed_when_the_server_is_saturated(monkeypatch):
+    called, sent = run_request(monkeypatch, "/api/admin/metrics")
+
+    assert called == ["/api/admin/metrics"]
+    assert sent == []
+
+
+def test_other_routes_are_shed_when_the_server_is_saturated(monkeypatch):
+    called, sent = run_request(monkeypatch, "/api/chatroom/")
+
+    assert called == []
+    assert sent[0]["status"] == 503
@@ -0,0 +1,17 @@
+import pytest
+from pydantic import ValidationError
+
+from app.server.models.events import MESSAGE_BATCH_MAX, ChatroomMessageBatchEvent
+
+
+def test_batch_up_to_the_limit_is_accepted():
+    event = ChatroomMessageBatchEvent.model_validate({"messages": [{}] * MESSAGE_BATCH_MAX})
+
+    assert len(event.messages) == MESSAGE_BATCH_MAX
+
+
+def test_oversized_batch_is_rejected():
+    with pytest.raises(ValidationError) as error:
+        ChatroomMessageBatchEvent.model_validate({"messages": [{}] * (MESSAGE_BATCH_MAX + 1)})
+
+    assert error.value.errors()[0]["type"] == "too_long"
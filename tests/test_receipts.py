@@ -0,0 +1,23 @@
+import asyncio
+
+from bson import ObjectId
+
+from app.server.middleware.receipts import ReadReceiptBuffer
+
+
+def test_failed_flushes_keep_at_most_max_pending_receipts_dropping_the_oldest():
+    buffer = ReadReceiptBuffer(max_pending=3)
+    message_ids = [ObjectId() for _ in range(5)]
+
+    async def failing_write(pending):
+        raise ConnectionError("database is down")
+
+    buffer._write = failing_write
+    buffer.add("alice", message_ids[:2])
+    buffer.add("bob", message_ids[2:])
+    asyncio.run(buffer.flush())
+
+    assert buffer._pending_count == 3
+    kept = set().union(*buffer._pending.values())
+    assert kept == set(message_ids[2:])
+    assert list(buffer._pending) == ["bob"]
@@ -0,0 +1,11 @@
+from bson.int64 import Int64
+
+from app.server.middleware.slow_queries import _shape_key, command_shape
+
+
+def test_get_more_shapes_by_collection_not_cursor_id():
+    first = command_shape("getMore", {"getMore": Int64(123), "collection": "Messages", "batchSize": 101})
+    second = command_shape("getMore", {"getMore": Int64(456), "collection": "Messages", "batchSize": 101})
+
+    assert first["collection"] == "Messages"
+    assert _shape_key(first) == _shape_key(second)
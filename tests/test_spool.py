@@ -0,0 +1,67 @@
+import asyncio
+import os
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from app.server.middleware import spool
+from app.server.middleware.spool import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, MessageSpool
+
+
+def half_open_spool(tmp_path):
+    message_spool = MessageSpool(directory=str(tmp_path))
+    message_spool.breaker = CircuitBreaker(failure_threshold=1, reset_seconds=0)
+    message_spool.breaker.record_failure()
+    assert message_spool.breaker.state == OPEN
+    return message_spool
+
+
+def test_trial_write_that_fails_for_another_reason_reopens_the_breaker(tmp_path, monkeypatch):
+    message_spool = half_open_spool(tmp_path)
+
+    async def insert_messages(documents):
+        assert message_spool.breaker.state == HALF_OPEN
+        raise OperationFailure("document failed validation")
+
+    monkeypatch.setattr(spool, "insert_messages", insert_messages)
+
+    with pytest.raises(OperationFailure):
+        asyncio.run(message_spool.store([{"_id": ObjectId()}]))
+    assert message_spool.breaker.state == OPEN
+    # The next probe is let through instead of the breaker staying stuck.
+    assert message_spool.breaker.allow()
+
+
+def test_replay_treats_duplicate_keys_as_already_replayed(tmp_path, monkeypatch):
+    message_spool = half_open_spool(tmp_path)
+    documents = [{"_id": ObjectId()}, {"_id": ObjectId()}]
+    stored = {documents[0]["_id"]}
+    calls = []
+
+    async def existing_message_ids(message_ids):
+        # The first check misses a write that landed after a cancelled insert.
+        return set() if not calls else stored & set(message_ids)
+
+    async def insert_messages(missing):
+        calls.append([document["_id"] for document in missing])
+        if len(calls) == 1:
+            raise BulkWriteError({"writeErrors": [{"index": 0, "code": 11000}], "nInserted": 0})
+        stored.update(document["_id"] for document in missing)
+
+    monkeypatch.setattr(spool, "existing_message_ids", existing_message_ids)
+    monkeypatch.setattr(spool, "insert_messages", insert_messages)
+
+    async def run():
+        await message_spool.start()
+        try:
+            await message_spool.append(documents)
+            await message_spool.replay()
+        finally:
+            await message_spool.stop()
+
+    asyncio.run(run())
+    assert calls[-1] == [documents[1]["_id"]]
+    assert stored == {document["_id"] for document in documents}
+    assert message_spool.breaker.state == CLOSED
+    assert not [name for name in os.listdir(message_spool._slot_dir) if name.endswith(".seg")]